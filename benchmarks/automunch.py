@@ -0,0 +1,72 @@
+"""
+Compares the original AutoMunch (deep munchify on construction, assigned values copied with toDict() and
+munchified again) against the lazy AutoMunch in miso.utils, on deeply nested and wide structures.
+
+    PYTHONPATH=. python benchmarks/automunch.py
+"""
+import timeit
+
+from munch import Munch, munchify
+from miso.utils import automunchify
+
+
+class OldAutoMunch(Munch):
+    def __setattr__(self, k, v):
+        if isinstance(v, (OldAutoMunch, Munch)):
+            v = munchify(v.toDict(), OldAutoMunch)
+        elif isinstance(v, dict):
+            v = munchify(v, OldAutoMunch)
+        elif isinstance(v, list):
+            v = [munchify(li, OldAutoMunch) for li in v]
+        super().__setattr__(k, v)
+
+
+def old_automunchify(data):
+    return munchify(data, OldAutoMunch)
+
+
+def deep(depth=200):
+    data = {'leaf': 1}
+    for _ in range(depth):
+        data = {'child': data, 'values': list(range(5))}
+    return data
+
+
+WIDE = {f'key{i}': {'id': i, 'nested': {'a': [1, 2, 3]}} for i in range(2000)}
+DEEP = deep()
+
+
+def read_one(munchify_):
+    return munchify_(WIDE).key1000.nested.a
+
+
+def read_deep(munchify_):
+    node = munchify_(DEEP)
+    while 'child' in node:
+        node = node.child
+    return node.leaf
+
+
+def pipeline(munchify_, steps=50):
+    """ Mirrors Service._pipeline: every step's output is assigned into a growing history """
+    history = []
+    detail = munchify_({'history': history, 'output': None})
+    output = {'rows': [{'id': i} for i in range(200)]}
+    for step in range(steps):
+        record = munchify_({'step': step, 'output': None})
+        record.output = output
+        detail.output = record
+        history.append(record)
+    return detail
+
+
+def main(number=10):
+    for name, func in (('wide, read one key', read_one), ('deep, walk to leaf', read_deep),
+                       ('pipeline history', pipeline)):
+        old = timeit.timeit(lambda: func(old_automunchify), number=number) / number
+        new = timeit.timeit(lambda: func(automunchify), number=number) / number
+        print(f'{name:<20} old {old * 1e3:9.3f} ms   new {new * 1e3:9.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares the cost of building a CachingShim cache key the old way (an indented, sorted dumps() hashed with
+md5) against the canonical key builder in miso.service.cache.
+
+    PYTHONPATH=. python benchmarks/cache_key.py
+"""
+import timeit
+import datetime
+
+from miso.encoder import dumps
+from miso.utils import md5sum
+from miso.service.cache import call_hash, key_arguments
+
+
+class Example:
+    def lookup(self, customer_id, report, options=None, since=None):
+        pass
+
+
+ARGS = (1234, [{'row': i, 'name': f'row {i}', 'values': list(range(20))} for i in range(200)])
+KWARGS = {'options': {'include_totals': True, 'currency': 'AUD'}, 'since': datetime.date(2021, 1, 1)}
+TOKEN = 'eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.eyJ0ZW5hbnRfaWQiOiJ0ZXN0aW5nIn0.signature'
+METHOD = Example().lookup
+
+
+def old_key():
+    return md5sum(dumps({
+        'service_id': 'example.lookup',
+        'args': ARGS,
+        'kwargs': KWARGS,
+        'username': 'someone',
+        'teant_id': 'testing'
+    }))
+
+
+def new_key():
+    return call_hash('example.lookup', key_arguments(METHOD, None, ARGS, KWARGS), TOKEN, [0, 0])
+
+
+def new_key_selected():
+    return call_hash('example.lookup', key_arguments(METHOD, ['customer_id', 'since'], ARGS, KWARGS), TOKEN, [0, 0])
+
+
+def main(number=500):
+    for name, func in (('old dumps+md5', old_key), ('canonical', new_key), ('canonical, cache_key=', new_key_selected)):
+        elapsed = timeit.timeit(func, number=number)
+        print(f'{name:<24} {elapsed / number * 1e6:10.1f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares the original betterjson codec (an isinstance chain when encoding, object_hook on every dict and the
+nine-field datetime encoding) against the table driven codec in miso.encoder with the compact encoding used for
+messages when MISO_COMPACT_ENCODING is set, on typical RPC payloads.
+
+    PYTHONPATH=. python benchmarks/encoder.py
+"""
+import json
+import timeit
+from datetime import datetime, timedelta, date
+
+import pendulum
+import pytz
+
+from miso.encoder import CompactJSONEncoder, JSONDecoder
+from miso.utils import Result
+
+
+class OldJSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, Result):
+            return dict(__type__='Result', **o.to_dict())
+        if isinstance(o, datetime):
+            if o.tzinfo and hasattr(o.tzinfo, 'name'):
+                return {
+                    '__type__': 'datetime', 'year': o.year, 'month': o.month, 'day': o.day, 'hour': o.hour,
+                    'minute': o.minute, 'second': o.second, 'microsecond': o.microsecond, 'tzinfo': o.tzinfo.name,
+                }
+            return {'__type__': 'datetime.isoformat', 'isoformat': o.isoformat()}
+        elif isinstance(o, date):
+            return {'__type__': 'date', 'year': o.year, 'month': o.month, 'day': o.day}
+        elif isinstance(o, timedelta):
+            return {'__type__': 'timedelta', 'days': o.days, 'seconds': o.seconds, 'microseconds': o.microseconds}
+        return json.JSONEncoder.default(self, o)
+
+
+class OldJSONDecoder(json.JSONDecoder):
+    def __init__(self):
+        json.JSONDecoder.__init__(self, object_hook=self.dict_to_object)
+
+    def dict_to_object(self, dict_):
+        if '__type__' not in dict_:
+            return dict_
+        type_ = dict_.pop('__type__')
+        if type_ == 'datetime':
+            usetz = dict_.get('tzinfo', None)
+            if usetz is not None:
+                if isinstance(usetz, str) and '/' not in usetz:
+                    usetz = 'Etc/GMT' + usetz.replace(':00', '').replace('+0', '+').replace('-0', '-')
+                dict_['tzinfo'] = pytz.timezone(usetz)
+            return pendulum.instance(datetime(**dict_))
+        elif type_ == 'datetime.isoformat':
+            return pendulum.parse(dict_['isoformat'])
+        elif type_ == 'timedelta':
+            return timedelta(**dict_)
+        elif type_ == 'date':
+            return pendulum.date(**dict_)
+        elif type_ == 'Result':
+            return Result(locked=True, **dict_)
+        dict_['__type__'] = type_
+        return dict_
+
+
+NOW = pendulum.now('Australia/Sydney')
+PAYLOADS = {
+    'Result with 200 dated rows': Result(data=[{
+        'id': i,
+        'name': f'customer {i}',
+        'created': NOW.subtract(days=i),
+        'due': date(2021, 1, 1) + timedelta(days=i),
+        'overdue_by': timedelta(hours=i),
+        'balance': i * 12.5,
+        'tags': ['a', 'b', 'c']
+    } for i in range(200)]),
+    'plain 200 rows (no types)': {'rows': [{'id': i, 'name': f'customer {i}', 'values': list(range(10))}
+                                           for i in range(200)]},
+}
+
+
+def main(number=50):
+    for name, payload in PAYLOADS.items():
+        old_text = OldJSONEncoder().encode(payload)
+        new_text = CompactJSONEncoder().encode(payload)
+        print(f'{name}: {len(old_text)} bytes -> {len(new_text)} bytes')
+        for label, encoder, decoder, text in (
+            ('old', OldJSONEncoder(), OldJSONDecoder(), old_text),
+            ('new', CompactJSONEncoder(), JSONDecoder(), new_text)
+        ):
+            encode = timeit.timeit(lambda: encoder.encode(payload), number=number) / number
+            decode = timeit.timeit(lambda: decoder.decode(text), number=number) / number
+            print(f'  {label}  encode {encode * 1e3:8.2f} ms   decode {decode * 1e3:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Compares the original Result (munchified in full on construction, with __getattribute__ overridden) against
+the slotted, lazily munchified Result in miso.utils, for a large list payload.
+
+    PYTHONPATH=. python benchmarks/result.py
+"""
+import timeit
+import tracemalloc
+
+from miso.utils import Result, AutoMunch, automunchify
+
+
+class OldResult(object):
+    def __init__(self, data=None, result=None, trace=None, locked=None, reason=None, detail=None):
+        self.data = automunchify(data) if data is not None else None
+        self.result = result if result is not None else bool(self.data)
+        self.reason = reason
+        self.detail = detail
+        self.trace = trace
+        self.locked = locked is True
+
+    def to_dict(self):
+        return {
+            'result': self.result,
+            'reason': self.reason,
+            'data': self.data.toDict() if isinstance(self.data, AutoMunch) else self.data,
+            'detail': self.detail.toDict() if isinstance(self.detail, AutoMunch) else self.detail,
+            'trace': self.trace
+        }
+
+    def __getattribute__(self, item):
+        real = super().__getattribute__(item)
+        if item == 'result':
+            real = real if real is not None else self.data is not None
+        return real
+
+
+ROWS = [{'id': i, 'name': f'customer {i}', 'address': {'city': 'Sydney', 'postcode': '2000'}, 'tags': ['a', 'b']}
+        for i in range(2000)]
+
+
+def memory(cls):
+    tracemalloc.start()
+    results = [cls(data=ROWS) for _ in range(5)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return size / 5
+
+
+def main(number=20):
+    for name, cls in (('old', OldResult), ('new', Result)):
+        construct = timeit.timeit(lambda: cls(data=ROWS), number=number) / number
+        round_trip = timeit.timeit(lambda: cls(data=ROWS).to_dict(), number=number) / number
+        access = timeit.timeit(lambda: cls(data=ROWS).data[0].address.city, number=number) / number
+        print(f'{name}  construct {construct * 1e3:8.3f} ms   to_dict {round_trip * 1e3:8.3f} ms   '
+              f'first access {access * 1e3:8.3f} ms   memory {memory(cls) / 1024:8.1f} KiB/result')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compares the size and speed of the betterjson and bettermsgpack serializers (as kombu uses them) on typical
+RPC payloads. Needs msgpack to be installed.
+
+    PYTHONPATH=. python benchmarks/serializers.py
+"""
+import timeit
+from datetime import date, timedelta
+
+import pendulum
+
+from miso.encoder import JSONEncoder, JSONDecoder, packb, unpackb
+from miso.utils import Result
+
+
+NOW = pendulum.now('Australia/Sydney')
+PAYLOADS = {
+    'Result with 200 dated rows': Result(data=[{
+        'id': i,
+        'name': f'customer {i}',
+        'created': NOW.subtract(days=i),
+        'due': date(2021, 1, 1) + timedelta(days=i),
+        'overdue_by': timedelta(hours=i),
+        'balance': i * 12.5,
+        'tags': ['a', 'b', 'c']
+    } for i in range(200)]),
+    'plain 200 rows (no types)': {'rows': [{'id': i, 'name': f'customer {i}', 'values': list(range(10))}
+                                           for i in range(200)]},
+    'small call': {'args': [1234, 'customer'], 'kwargs': {'since': date(2021, 1, 1)}},
+}
+
+
+def main(number=100):
+    encoder, decoder = JSONEncoder(), JSONDecoder()
+    serializers = (
+        ('betterjson', lambda data: encoder.encode(data).encode('utf-8'), lambda data: decoder.decode(data.decode())),
+        ('bettermsgpack', packb, unpackb)
+    )
+    for name, payload in PAYLOADS.items():
+        print(name)
+        for label, dump, load in serializers:
+            data = dump(payload)
+            encode = timeit.timeit(lambda: dump(payload), number=number) / number
+            decode = timeit.timeit(lambda: load(data), number=number) / number
+            print(f'  {label:<14} {len(data):8} bytes   encode {encode * 1e3:8.3f} ms   decode {decode * 1e3:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
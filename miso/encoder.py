@@ -1,107 +1,429 @@
 import json
-from datetime import datetime, timedelta, date, tzinfo
+import uuid
+import zlib
+import struct
+import functools
+from logging import getLogger
+from datetime import datetime, timedelta, date
 
 import pendulum
-import pytz
 from kombu.serialization import register
 
 from .utils import Result
 
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, without it only betterjson is available
+    msgpack = None
+
+
+TYPE_MARKER = '"__type__"'
+LOG = getLogger('miso.encoder')
+DEFAULT_CLAIM_TTL = 3600
+# Set by register_better_json when the config has MISO_REDIS, see ClaimCheck
+CLAIM_CHECK = None
+
+
+def encode_result(o):
+    return dict(__type__='Result', **o.to_dict())
+
+
+def encode_compact_datetime(o):
+    value = {'__type__': 'dt', 'v': [o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond]}
+    if o.tzinfo is not None:
+        name = getattr(o.tzinfo, 'name', None)
+        if isinstance(name, str) and not name.startswith(('+', '-')):
+            value['tz'] = name
+        else:
+            value['tz'] = int(o.utcoffset().total_seconds())
+    return value
+
+
+def encode_compact_date(o):
+    return {'__type__': 'd', 'v': [o.year, o.month, o.day]}
+
+
+def encode_compact_timedelta(o):
+    return {'__type__': 'td', 'v': [o.days, o.seconds, o.microseconds]}
+
+
+def encode_datetime(o):
+    if o.tzinfo and hasattr(o.tzinfo, 'name'):
+        return {
+            '__type__': 'datetime',
+            'year': o.year,
+            'month': o.month,
+            'day': o.day,
+            'hour': o.hour,
+            'minute': o.minute,
+            'second': o.second,
+            'microsecond': o.microsecond,
+            'tzinfo': o.tzinfo.name,
+        }
+    return {
+        '__type__': 'datetime.isoformat',
+        'isoformat': o.isoformat()
+    }
+
+
+def encode_date(o):
+    return {
+        '__type__': 'date',
+        'year': o.year,
+        'month': o.month,
+        'day': o.day
+    }
+
+
+def encode_timedelta(o):
+    return {
+        '__type__': 'timedelta',
+        'days': o.days,
+        'seconds': o.seconds,
+        'microseconds': o.microseconds,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def timezone(tz):
+    """ A (cached) pendulum timezone from a name or an offset in seconds, naive datetimes are taken to be UTC """
+    if tz is None:
+        return pendulum.UTC
+    if isinstance(tz, int):
+        return pendulum.fixed_timezone(tz)
+    return pendulum.timezone(tz)
+
+
+def decode_compact_datetime(dict_):
+    return pendulum.DateTime(*dict_['v'], tzinfo=timezone(dict_.get('tz')))
+
+
+def decode_compact_date(dict_):
+    return pendulum.Date(*dict_['v'])
+
+
+def decode_compact_timedelta(dict_):
+    return timedelta(*dict_['v'])
+
+
+def decode_result(dict_):
+    return Result(locked=True, **dict_)
+
+
+def offset_seconds(name):
+    """ Timezones without a name are written as their offset, e.g. '+05:30' """
+    sign = -1 if name.startswith('-') else 1
+    hours, _, minutes = name[1:].partition(':')
+    return sign * (int(hours) * 3600 + int(minutes or 0) * 60)
+
+
+def decode_datetime(dict_):
+    usetz = dict_.pop('tzinfo', None)
+    if isinstance(usetz, str) and usetz.startswith(('+', '-')):
+        usetz = offset_seconds(usetz)
+    return pendulum.DateTime(tzinfo=timezone(usetz), **dict_)
+
+
+def decode_datetime_isoformat(dict_):
+    return pendulum.parse(dict_['isoformat'])
+
+
+def decode_date(dict_):
+    return pendulum.date(**dict_)
+
+
+def decode_timedelta(dict_):
+    return timedelta(**dict_)
+
+
+# Types are looked up by their class first and then along their MRO (pendulum's DateTime is a datetime, which is
+# itself a date, so the order of the MRO matters), the result of a lookup is remembered
+ENCODERS = {
+    Result: encode_result,
+    datetime: encode_datetime,
+    date: encode_date,
+    timedelta: encode_timedelta
+}
+# The compact encoding is only used for messages between nodes, see register_better_json
+COMPACT_ENCODERS = {
+    Result: encode_result,
+    datetime: encode_compact_datetime,
+    date: encode_compact_date,
+    timedelta: encode_compact_timedelta
+}
+# Every __type__ we have ever written is still understood
+DECODERS = {
+    'Result': decode_result,
+    'dt': decode_compact_datetime,
+    'd': decode_compact_date,
+    'td': decode_compact_timedelta,
+    'datetime': decode_datetime,
+    'datetime.isoformat': decode_datetime_isoformat,
+    'date': decode_date,
+    'timedelta': decode_timedelta
+}
+
+
+def find_encoder(table, cls):
+    for base in cls.__mro__:
+        if base in table:
+            table[cls] = table[base]
+            return table[cls]
+    table[cls] = None
+
 
 class JSONEncoder(json.JSONEncoder):
     """
-    Converts a python object, where datetime and timedelta objects are converted
-    into objects that can be decoded using the DateTimeAwareJSONDecoder.
+    Converts a python object, where Result, datetime, date and timedelta objects are converted
+    into objects that can be decoded using the JSONDecoder.
     """
+    encoders = ENCODERS
 
     def default(self, o):  # pylint: disable=E0202
-        if isinstance(o, Result):
-            return dict(
-                __type__='Result',
-                **o.to_dict()
-            )
-        if isinstance(o, datetime):
-            if o.tzinfo and hasattr(o.tzinfo, 'name'):
-                return {
-                    '__type__': 'datetime',
-                    'year': o.year,
-                    'month': o.month,
-                    'day': o.day,
-                    'hour': o.hour,
-                    'minute': o.minute,
-                    'second': o.second,
-                    'microsecond': o.microsecond,
-                    'tzinfo': o.tzinfo.name,
-                }
-            else:
-                return {
-                    '__type__': 'datetime.isoformat',
-                    'isoformat': o.isoformat()
-                }
-        elif isinstance(o, date):
-            return {
-                '__type__': 'date',
-                'year': o.year,
-                'month': o.month,
-                'day': o.day
-            }
-        elif isinstance(o, timedelta):
-            return {
-                '__type__': 'timedelta',
-                'days': o.days,
-                'seconds': o.seconds,
-                'microseconds': o.microseconds,
-            }
-        else:
+        table = self.encoders
+        cls = type(o)
+        encoder = table[cls] if cls in table else find_encoder(table, cls)
+        if encoder is None:
             return json.JSONEncoder.default(self, o)
+        return encoder(o)
+
+
+class CompactJSONEncoder(JSONEncoder):
+    """ Encodes datetime, date and timedelta objects compactly (as lists of their fields), which only nodes
+        that know the dt, d and td types can decode.
+    """
+    encoders = COMPACT_ENCODERS
 
 
 class JSONDecoder(json.JSONDecoder):
     """
-    Converts a json string, where datetime and timedelta objects were converted
-    into objects using the DateTimeAwareJSONEncoder, back into a python object.
+    Converts a json string, where Result, datetime, date and timedelta objects were converted
+    into objects using the JSONEncoder, back into a python object.
     """
 
     def __init__(self):
         json.JSONDecoder.__init__(self, object_hook=self.dict_to_object)
 
+    def decode(self, s, *args, **kwargs):
+        # Without a single __type__ there is nothing to convert, so skip calling object_hook for every dict
+        if TYPE_MARKER not in s:
+            return PLAIN_DECODER.decode(s, *args, **kwargs)
+        return json.JSONDecoder.decode(self, s, *args, **kwargs)
+
     def dict_to_object(self, dict_):
-        """ Convert a dictionary with a __type__ key into special objects """
-        if '__type__' not in dict_:
+        """ Convert a dictionary with a (known) __type__ key into special objects """
+        type_ = dict_.get('__type__')
+        decoder = DECODERS.get(type_) if isinstance(type_, str) else None
+        if decoder is None:
             return dict_
+        del dict_['__type__']
+        return decoder(dict_)
 
-        type_ = dict_.pop('__type__')
-        if type_ == 'datetime':
-            usetz = dict_.get('tzinfo', None)
-            if usetz is not None:
-                # If usetz is a string like '+01:00' try to replace with 'Etc/GMT+1'
-                if isinstance(usetz, str) and '/' not in usetz:
-                    usetz = 'Etc/GMT' + usetz.replace(':00', '').replace('+0', '+').replace('-0', '-')
-                dict_['tzinfo'] = pytz.timezone(usetz)
-
-            return pendulum.instance(datetime(**dict_))
-        elif type_ == 'datetime.isoformat':
-            return pendulum.parse(dict_['isoformat'])
-        elif type_ == 'timedelta':
-            return timedelta(**dict_)
-        elif type_ == 'date':
-            return pendulum.date(**dict_)
-        elif type_ == 'Result':
-            return Result(locked=True, **dict_)
-        else:
-            # Oops... better put this back together.
-            dict_['__type__'] = type_
-            return dict_
+
+PLAIN_DECODER = json.JSONDecoder()
 
 
 def loads(data):
     return json.loads(data, cls=JSONDecoder)
 
 
-def dumps(data, sort_keys=True, indent=2):
-    return json.dumps(data, cls=JSONEncoder, sort_keys=sort_keys, indent=indent)
+def dumps(data, sort_keys=True, indent=2, separators=None):
+    return json.dumps(data, cls=JSONEncoder, sort_keys=sort_keys, indent=indent, separators=separators)
+
 
+# MessagePack extension type codes used by bettermsgpack
+EXT_RESULT = 1
+EXT_DATETIME = 2
+EXT_DATE = 3
+EXT_TIMEDELTA = 4
+EXT_CLAIM = 5
+
+
+def pack_result(o):
+    return msgpack.ExtType(EXT_RESULT, packb(o.to_dict()))
+
+
+DATETIME_FORMAT = struct.Struct('>hBBBBBI')
+DATE_FORMAT = struct.Struct('>hBB')
+TIMEDELTA_FORMAT = struct.Struct('>iII')
+OFFSET_FORMAT = struct.Struct('>i')
+
+
+def pack_datetime(o):
+    """ Fixed size fields followed by the timezone: nothing (naive), b'n' + name or b'o' + offset in seconds """
+    data = DATETIME_FORMAT.pack(o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond)
+    if o.tzinfo is not None:
+        name = getattr(o.tzinfo, 'name', None)
+        if isinstance(name, str) and not name.startswith(('+', '-')):
+            data += b'n' + name.encode('utf-8')
+        else:
+            data += b'o' + OFFSET_FORMAT.pack(int(o.utcoffset().total_seconds()))
+    return msgpack.ExtType(EXT_DATETIME, data)
+
+
+def pack_date(o):
+    return msgpack.ExtType(EXT_DATE, DATE_FORMAT.pack(o.year, o.month, o.day))
+
+
+def pack_timedelta(o):
+    return msgpack.ExtType(EXT_TIMEDELTA, TIMEDELTA_FORMAT.pack(o.days, o.seconds, o.microseconds))
+
+
+def unpack_datetime(data):
+    tz, size = None, DATETIME_FORMAT.size
+    if data[size:size + 1] == b'n':
+        tz = data[size + 1:].decode('utf-8')
+    elif data[size:size + 1] == b'o':
+        tz = OFFSET_FORMAT.unpack_from(data, size + 1)[0]
+    return pendulum.DateTime(*DATETIME_FORMAT.unpack_from(data), tzinfo=timezone(tz))
+
+
+PACKERS = {
+    Result: pack_result,
+    datetime: pack_datetime,
+    date: pack_date,
+    timedelta: pack_timedelta
+}
+UNPACKERS = {
+    EXT_RESULT: lambda data: Result(locked=True, **unpackb(data)),
+    EXT_DATETIME: unpack_datetime,
+    EXT_DATE: lambda data: pendulum.Date(*DATE_FORMAT.unpack(data)),
+    EXT_TIMEDELTA: lambda data: timedelta(*TIMEDELTA_FORMAT.unpack(data))
+}
+
+
+def pack_default(o):
+    cls = type(o)
+    packer = PACKERS[cls] if cls in PACKERS else find_encoder(PACKERS, cls)
+    if packer is None:
+        raise TypeError(f'Object of type {cls.__name__} is not msgpack serializable')
+    return packer(o)
+
+
+def unpack_ext(code, data):
+    if code in UNPACKERS:
+        return UNPACKERS[code](data)
+    return msgpack.ExtType(code, data)
+
+
+def packb(data):
+    return msgpack.packb(data, default=pack_default, use_bin_type=True)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, ext_hook=unpack_ext, raw=False, strict_map_key=False)
+
+
+class ClaimCheck:
+    """ Keeps large messages out of the broker: a message of at least threshold bytes is written to Redis
+        (compressed, as miso:blob:<uuid>, kept for ttl seconds) and only a reference to it is sent. Whoever
+        decodes the message fetches the blob again, so neither the caller nor the called service notices.
+        The ttl must outlast the longest a message may wait in a queue.
+
+        Without a threshold nothing is checked in, but references sent by other nodes are still resolved.
+    """
+
+    def __init__(self, redis, threshold=None, ttl=DEFAULT_CLAIM_TTL):
+        self.redis = redis
+        self.threshold = threshold
+        self.ttl = ttl
+
+    def wanted(self, data):
+        return self.threshold is not None and len(data) >= self.threshold
+
+    def check_in(self, data):
+        """ Store a serialised message, returns the key of its blob """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        key = f'miso:blob:{uuid.uuid4().hex}'
+        self.redis.raw.set(key, zlib.compress(data, self.redis.compress_level), ex=self.ttl)
+        return key
+
+    def check_out(self, key):
+        """ Returns the serialised message stored under key, or None if it has expired """
+        data = self.redis.raw.get(key)
+        return zlib.decompress(data) if data is not None else None
+
+
+def resolve_claim(key, decode):
+    """ Fetch and decode a message sent by claim check. Raising here would stop the service consuming altogether,
+        so a message that cannot be fetched becomes a failed reply instead: its caller gets a RemoteError (and
+        a request without args is rejected as malformed).
+    """
+    data = CLAIM_CHECK.check_out(key) if CLAIM_CHECK is not None else None
+    if data is not None:
+        return decode(data)
+
+    if CLAIM_CHECK is None:
+        reason = f'Received claim check {key}, but MISO_REDIS is not configured'
+    else:
+        reason = f'Claim check {key} has expired (after MISO_CLAIM_CHECK.ttl seconds) or does not exist'
+    LOG.error(reason)
+    return {
+        'result': None,
+        'error': {'exc_type': 'ClaimCheckError', 'exc_path': 'miso.encoder.ClaimCheckError', 'exc_args': [reason],
+                  'value': reason}
+    }
+
+
+def encode_message(body):
+    """ betterjson, with large messages sent by claim check """
+    data = MESSAGE_ENCODER.encode(body)
+    if CLAIM_CHECK is not None and CLAIM_CHECK.wanted(data):
+        return MESSAGE_ENCODER.encode({'__type__': 'claim', 'key': CLAIM_CHECK.check_in(data)})
+    return data
+
+
+def decode_message(data):
+    """ betterjson, resolving a message sent by claim check. Only whole messages are claim checks, the JSONDecoder
+        itself (used for Redis values and the like) leaves them alone.
+    """
+    body = MESSAGE_DECODER.decode(data)
+    if isinstance(body, dict) and body.get('__type__') == 'claim':
+        return resolve_claim(body['key'], loads)
+    return body
+
+
+def pack_message(body):
+    """ bettermsgpack, with large messages sent by claim check """
+    data = packb(body)
+    if CLAIM_CHECK is not None and CLAIM_CHECK.wanted(data):
+        return packb(msgpack.ExtType(EXT_CLAIM, CLAIM_CHECK.check_in(data).encode('utf-8')))
+    return data
+
+
+def unpack_message(data):
+    """ bettermsgpack, resolving a message sent by claim check """
+    body = unpackb(data)
+    if isinstance(body, msgpack.ExtType) and body.code == EXT_CLAIM:
+        return resolve_claim(body.data.decode('utf-8'), unpackb)
+    return body
+
+
+MESSAGE_ENCODER = JSONEncoder()
+MESSAGE_DECODER = JSONDecoder()
+
+
+def register_better_json(config=None):
+    """ Register our serializers for use throughout our nameko project: betterjson and, when msgpack is
+        installed, bettermsgpack (a binary encoding of the same types). Pick one with the serializer config key.
+
+        With MISO_COMPACT_ENCODING set, betterjson messages use the compact encoding (see CompactJSONEncoder).
+        Only turn it on once every node in the cluster can decode it.
+
+        Given a config with MISO_REDIS, messages of at least MISO_CLAIM_CHECK.threshold bytes are sent by claim
+        check (see ClaimCheck) and claim check references are resolved when decoding.
+    """
+    global CLAIM_CHECK, MESSAGE_ENCODER
+    if config is not None:
+        MESSAGE_ENCODER = CompactJSONEncoder() if config.get('MISO_COMPACT_ENCODING') else JSONEncoder()
+    if config is not None and 'MISO_REDIS' in config:
+        from .provider.redis import Redis
+        settings = config.get('MISO_CLAIM_CHECK') or {}
+        CLAIM_CHECK = ClaimCheck(
+            Redis.get_redis(config), settings.get('threshold'), settings.get('ttl', DEFAULT_CLAIM_TTL)
+        )
 
-def register_better_json():
-    """ Register this serializer for use throughout our nameko project """
-    register('betterjson', JSONEncoder().encode, JSONDecoder().decode, 'application/x-better-json', 'utf-8')
+    register('betterjson', encode_message, decode_message, 'application/x-better-json', 'utf-8')
+    if msgpack is not None:
+        register('bettermsgpack', pack_message, unpack_message, 'application/x-better-msgpack', 'binary')
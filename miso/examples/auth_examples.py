@@ -1,10 +1,9 @@
-from nameko.rpc import RpcProxy
-from miso.service import Service, rpc_enhanced
+from miso.service import Service, CircuitRpcProxy, rpc_enhanced
 
 
 class AuthExampleService(Service):
     name = 'auth_examples'
-    proxy_self = RpcProxy('auth_examples2')
+    proxy_self = CircuitRpcProxy('auth_examples2', timeout=10)
 
     @rpc_enhanced(require_auth=True)
     def confirm_authenticated(self):
@@ -9,7 +9,15 @@ class CacheExampleService(Service):
     def epoch(self):
         return epoch()
 
-    @rpc_enhanced(cache_time=120)
+    @rpc_enhanced(cache_time=60, batch=True)
+    def square(self, n):
+        return n * n
+
+    def square_batch(self, items):
+        """ Vectorised square_many, gets every uncached n at once """
+        return [n * n for n in items]
+
+    @rpc_enhanced(cache_time=120, cache_coalesce=True, lane='slow')
     def slow_method(self):
         sleep(5)
         return 'The slow method has completed'
@@ -12,3 +12,8 @@ class HttpExampleService(Service):
     @http_enhanced('GET', '/hostname_full', require_auth=True)
     def hostname_full(self, request):
         return self.new_result(hostname(short=False))
+
+    @http_enhanced('GET', '/count/<int:limit>')
+    def count(self, request, limit):
+        """ Streams {"n": 0} .. {"n": limit - 1} as NDJSON, one line at a time """
+        return ({'n': n} for n in range(limit))
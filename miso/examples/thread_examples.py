@@ -7,6 +7,13 @@ class ThreadExampleService(Service):
 
     @rpc_enhanced(threaded=True)
     def prime_threaded(self, n=1000):
+        return self.nth_prime(n)
+
+    @rpc_enhanced(threaded='process')
+    def prime_process(self, n=1000):
+        return self.nth_prime(n)
+
+    def nth_prime(self, n):
         self.logger.debug("Calculating %dth prime", n)
         primes = []
         for i in itertools.count(2):
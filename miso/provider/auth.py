@@ -65,10 +65,13 @@ class Auth:
             return False
 
         user_key = f'miso:tenants:{tenant_id}:users:{username}'
-        tenant_enabled = self.redis.getj(f'miso:tenants:{tenant_id}:enabled')
-        user_enabled = self.redis.getj(f'{user_key}:enabled')
-        user_password = self.redis.getj(f'{user_key}:password')
-        user_roles = self.redis.getj(f'{user_key}:roles') or []
+        tenant_enabled, user_enabled, user_password, user_roles = self.redis.mgetj([
+            f'miso:tenants:{tenant_id}:enabled',
+            f'{user_key}:enabled',
+            f'{user_key}:password',
+            f'{user_key}:roles'
+        ])
+        user_roles = user_roles or []
 
         if not user_enabled:
             LOG.error('username is disabled: %s (%s)', username, tenant_id)
@@ -1,4 +1,6 @@
 import json
+import time
+import zlib
 from logging import getLogger
 from nameko.extensions import DependencyProvider
 from redis import StrictRedis
@@ -6,6 +8,95 @@ from miso.encoder import JSONDecoder, JSONEncoder
 
 
 LOG = getLogger('miso.provider.redis')
+COMPRESSED_HEADER = b'\x00mz1'  # Can never be the start of a JSON document
+DEFAULT_COMPRESS_THRESHOLD = 4096
+DEFAULT_COMPRESS_LEVEL = 6
+
+# KEYS[1] bucket, ARGV capacity, refill rate (tokens per second), now (epoch), cost
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+def encode_json(val, compress_threshold=None, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """ Encode a value as compact JSON, compressing it (behind a small header) if it is large enough """
+    data = json.dumps(val, cls=JSONEncoder, separators=(',', ':')).encode('utf-8')
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        data = COMPRESSED_HEADER + zlib.compress(data, compress_level)
+    return data
+
+
+def decode_json(data):
+    """ Decode a value stored by encode_json, values stored as plain (or indented) JSON are also accepted """
+    if data is None:
+        return None
+    if data.startswith(COMPRESSED_HEADER):
+        data = zlib.decompress(data[len(COMPRESSED_HEADER):])
+    return json.loads(data, cls=JSONDecoder)
+
+
+class JsonPipeline:
+    """ A pipeline whose getj/setj read and write JSON values as Redis.getj/setj do, every other command is
+        passed to the underlying pipeline (and replies with raw bytes). Commands are sent together by execute(),
+        which returns their replies with getj values decoded. Used as a context manager, commands still queued
+        when the block ends are sent then.
+    """
+
+    def __init__(self, redis, transaction=False):
+        self.redis = redis
+        self.pipe = redis.raw.pipeline(transaction=transaction)
+        self.decoders = []
+
+    def getj(self, name):
+        self.pipe.get(name)
+        self.decoders.append(decode_json)
+        return self
+
+    def setj(self, name, val, ttl=None):
+        """ Set a JSON value, which expires after ttl seconds when given """
+        self.pipe.set(name, self.redis.encode(val), ex=ttl)
+        self.decoders.append(None)
+        return self
+
+    def execute(self):
+        decoders, self.decoders = self.decoders, []
+        if not decoders:
+            return []
+        replies = self.pipe.execute()
+        return [reply if decoder is None else decoder(reply) for decoder, reply in zip(decoders, replies)]
+
+    def __getattr__(self, name):
+        command = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs):
+            command(*args, **kwargs)
+            self.decoders.append(None)
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        self.decoders = []
+        self.pipe.reset()
 
 
 class RedisProvider(DependencyProvider):
@@ -23,10 +114,13 @@ class Redis:
 
     def __init__(self, config):
         self.logger = getLogger('miso.provider.redis')
-        self.conn = StrictRedis.from_url(
-            config['MISO_REDIS']['url'],
-            **config['MISO_REDIS'].get('options', {})
-        )
+        options = config['MISO_REDIS'].get('options', {})
+        self.conn = StrictRedis.from_url(config['MISO_REDIS']['url'], **options)
+        # JSON values may be compressed, so they are read and written without decoding responses
+        self.raw = StrictRedis.from_url(config['MISO_REDIS']['url'], **dict(options, decode_responses=False))
+        self.compress_threshold = config['MISO_REDIS'].get('compress_threshold', DEFAULT_COMPRESS_THRESHOLD)
+        self.compress_level = config['MISO_REDIS'].get('compress_level', DEFAULT_COMPRESS_LEVEL)
+        self._token_bucket = self.conn.register_script(TOKEN_BUCKET_SCRIPT)
 
     @classmethod
     def get_redis(cls, config=None, container=None):
@@ -44,32 +138,71 @@ class Redis:
         if not name.startswith('miso:'):
             self.logger.debug('set_type: %s : %s = %s', name, type_obj, val)
         if type_obj == 'json':
-            val = json.dumps(val, cls=JSONEncoder, sort_keys=True, indent=2)
-        else:
-            val = type_obj(val)
-        return self.conn.set(name, val)
+            return self.raw.set(name, self.encode(val))
+        return self.conn.set(name, type_obj(val))
 
     def get_type(self, name, type_obj):
         if not name.startswith('miso:'):
             self.logger.debug('get_type: %s - %s waiting..', name, type_obj)
-        val = self.conn.get(name)
         if type_obj == 'json':
-            if val is not None:
-                val = json.loads(val, cls=JSONDecoder)
+            val = decode_json(self.raw.get(name))
         else:
-            val = type_obj(val)
+            val = type_obj(self.conn.get(name))
         if not name.startswith('miso:'):
             self.logger.debug('get_type: %s - %s returned %s', name, type_obj, val)
         return val
 
+    def encode(self, val):
+        return encode_json(val, self.compress_threshold, self.compress_level)
+
     def getj(self, name):
         return self.get_type(name, 'json')
 
+    def getj_ttl(self, name):
+        """ Returns the decoded value along with its remaining time to live (in seconds) in one round trip """
+        with self.pipelinej() as pipe:
+            val, ttl = pipe.getj(name).pttl(name).execute()
+        return val, (ttl / 1000 if ttl and ttl > 0 else None)
+
     def setj(self, name, val):
         return self.set_type(name, val, 'json')
 
+    def mgetj(self, names):
+        """ Returns the decoded values of several keys (None for missing keys) in one round trip """
+        names = list(names)
+        if not names:
+            return []
+        return [decode_json(val) for val in self.raw.mget(names)]
+
+    def msetj(self, mapping, ttl=None):
+        """ Sets several JSON values in one round trip, each expiring after ttl seconds when given """
+        if not mapping:
+            return
+        if ttl is None:
+            self.raw.mset({name: self.encode(val) for name, val in mapping.items()})
+            return
+        with self.pipelinej() as pipe:
+            for name, val in mapping.items():
+                pipe.setj(name, val, ttl)
+
+    def pipelinej(self, transaction=False):
+        """ A JsonPipeline, e.g.
+
+            with redis.pipelinej() as pipe:
+                enabled, roles = pipe.getj('...:enabled').getj('...:roles').execute()
+        """
+        return JsonPipeline(self, transaction)
+
+    def take_token(self, name, capacity, rate, cost=1):
+        """ Atomically take tokens from a token bucket (refilled at rate tokens per second, holding at most
+            capacity tokens). Returns whether the tokens were available and how many tokens remain.
+        """
+        allowed, tokens = self._token_bucket(keys=[name], args=[capacity, rate, time.time(), cost])
+        return bool(allowed), float(tokens)
+
     def keys(self, key_search, idx=None):
-        for key in self.conn.keys(key_search):
+        """ Iterates over matching keys using SCAN, which (unlike KEYS) does not block the server """
+        for key in self.conn.scan_iter(match=key_search):
             if idx is None:
                 yield key
             else:
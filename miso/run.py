@@ -30,7 +30,7 @@ class MisoRunner:
             self.config = dict(**EnvYAML(config_file))
 
         logging.config.dictConfig(self.config['LOGGING'])
-        register_better_json()
+        register_better_json(self.config)
 
         self.config['SERVICE_CONTAINER_CLS'] = SERVICE_CONTAINER_CLS
         self.logger = logging.getLogger('miso.run')
@@ -79,7 +79,7 @@ class MisoRunner:
         while stopped is False:
             store = ServiceStore(from_modules=self.modules)
             self.logger.info('Starting nameko containers with %s', store.services)
-            with run_services(self.config, *store.services, kill_on_exit=True):
+            with run_services(self.config, *store.services, kill_on_exit=True) as runner:
                 while True:
                     try:
                         if not self.stateless:
@@ -91,7 +91,7 @@ class MisoRunner:
                                 self.state.update(stopped=epoch())
                             break
                         if not self.stateless:
-                            self.state.update(last_seen=epoch())
+                            self.state.update(last_seen=epoch(), rejections=self.rejections(runner))
                     except KeyboardInterrupt:
                         self.logger.warning('Stopping nameko containers (someone hit ^C)')
                         if not self.stateless:
@@ -99,6 +99,14 @@ class MisoRunner:
                         stopped = True
                         break
 
+    @staticmethod
+    def rejections(runner):
+        """ Calls shed by admission control since the containers started, by service.method """
+        rejections = {}
+        for container in runner.containers:
+            rejections.update(getattr(container, 'miso_rejections', {}))
+        return rejections
+
 
 def env_from_file(env_file, require_env=False):
     if not os.path.exists(env_file):
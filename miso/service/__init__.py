@@ -1,11 +1,13 @@
 from logging import getLogger
-from munch import munchify
 
-from miso.utils import Result, hostname
+from miso.utils import Result, AutoMunch, automunchify, hostname
 from miso.provider import MisoProviderWrapper
 from miso.provider.auth import AuthProvider, Auth
 from miso.provider.redis import RedisProvider, Redis
-from miso.service.modification import rpc_enhanced, http_enhanced, timer_enhanced, RpcProxy
+from miso.service.cache import CacheProvider, CacheControl
+from miso.service.circuit import CircuitRpcProxy, CircuitClusterProxy
+from miso.service.batch import call_many
+from miso.service.modification import rpc_enhanced, http_enhanced, timer_enhanced, RpcProxy, batch_entrypoint
 
 
 __all__ = [
@@ -14,7 +16,10 @@ __all__ = [
     'timer_enhanced',
     'Service',
     'Result',
-    'RpcProxy'
+    'RpcProxy',
+    'CircuitRpcProxy',
+    'CircuitClusterProxy',
+    'call_many'
 ]
 
 
@@ -22,9 +27,18 @@ class Service:
     name = None
     redis: Redis = RedisProvider()
     auth: Auth = AuthProvider()
+    cache: CacheControl = CacheProvider()
 
     _miso_service_obj = True
 
+    def __init_subclass__(cls, **kwargs):
+        """ Add a <method>_many entrypoint for every batch=True method """
+        super().__init_subclass__(**kwargs)
+        for name, method in list(vars(cls).items()):
+            options = getattr(method, '_miso_options', None)
+            if options is not None and options.batch and not hasattr(cls, f'{name}_many'):
+                setattr(cls, f'{name}_many', batch_entrypoint(name, options))
+
     def __init__(self):
         if not self.name:
             raise ValueError('Service class has no name property')
@@ -50,12 +64,12 @@ class Service:
         return Result(*args, **kwargs)
 
     def _pipeline(self, process_steps, inputs=None):
-        inputs = munchify(inputs or {})
+        inputs = automunchify(inputs or {})
         history = []
         reason = None
 
         for idx, (func, args) in enumerate(process_steps):
-            history.append(munchify({
+            history.append(AutoMunch({
                 'step': idx+1,
                 'func_name': func.__func__.__name__,
                 'output': None,
@@ -87,6 +101,6 @@ class Service:
 
         return self.construct_result(
             result=output and output.result is True,
-            detail=munchify({'inputs': inputs, 'history': history}),
+            detail=AutoMunch({'inputs': inputs, 'history': history}),
             reason=reason
         )
@@ -0,0 +1,59 @@
+from logging import getLogger
+from miso.utils import Result
+
+
+LOG = getLogger('miso.service.batch')
+DEFAULT_CHUNK_SIZE = 100
+
+
+def item_arguments(item):
+    """ Returns (args, kwargs) for one item of a batch: a dict holds keyword arguments, a list or tuple holds
+        positional arguments and anything else is the only argument (so a single list argument must be wrapped).
+    """
+    if isinstance(item, dict):
+        return (), item
+    if isinstance(item, (list, tuple)):
+        return tuple(item), {}
+    return (item,), {}
+
+
+def run_batch(service, name, items):
+    """ Runs a batch=True method for every item, using the service's vectorised <method>_batch(items) if it has
+        one (which must return one result per item, in order) or calling the method once per item otherwise.
+    """
+    vectorised = getattr(service, f'{name}_batch', None)
+    if vectorised is not None:
+        return list(vectorised(items))
+
+    method = getattr(service, name)
+    results = []
+    for item in items:
+        args, kwargs = item_arguments(item)
+        try:
+            results.append(method(*args, **kwargs))
+        except Exception:
+            LOG.exception('%s.%s raised an exception for one item of a batch', service.name, name)
+            results.append(Result(result=False, reason='exception in the called service'))
+    return results
+
+
+def call_many(service_proxy, name, items, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Calls <name>_many on a service proxy, splitting large batches into chunks which are sent at the same
+        time. Returns one result per item, a chunk that failed as a whole fails each of its items.
+    """
+    items = list(items)
+    method = getattr(service_proxy, f'{name}_many')
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    if hasattr(method, 'call_async'):
+        replies = [method.call_async(chunk) for chunk in chunks]
+        chunk_results = [reply.result() for reply in replies]
+    else:
+        chunk_results = [method(chunk) for chunk in chunks]
+
+    results = []
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        if isinstance(chunk_result, list):
+            results.extend(chunk_result)
+        else:
+            results.extend([chunk_result] * len(chunk))
+    return results
@@ -0,0 +1,178 @@
+import json
+import time
+import hashlib
+import inspect
+import functools
+from collections import OrderedDict, Counter, defaultdict
+from nameko.extensions import DependencyProvider
+from miso.encoder import JSONEncoder
+from miso.provider.redis import Redis
+from miso.utils import epoch, force_list
+
+
+DEFAULT_LOCAL_SIZE = 1024
+GENERATION_MEMO_TIME = 1
+MISSING = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _signature(func):
+    return inspect.signature(func)
+
+
+def key_arguments(method, cache_key, args, kwargs):
+    """ Select the parts of a call that identify it for caching. cache_key may be a list of argument names
+        (everything else is ignored) or a callable which is given the arguments and returns the key.
+    """
+    if not cache_key:
+        return [args, kwargs]
+    if callable(cache_key):
+        return cache_key(*args, **kwargs)
+    bound = _signature(method.__func__).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    return {name: bound.arguments.get(name) for name in force_list(cache_key)}
+
+
+def call_hash(service_id, key_args, identity, generations):
+    """ A fast hash of the canonical (compact, sorted) JSON representation of a call """
+    canonical = json.dumps(
+        [service_id, key_args, identity, generations], cls=JSONEncoder, separators=(',', ':'), sort_keys=True
+    )
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def cache_identity(auth):
+    """ Who a call is cached for: the verified tenant, user and roles of the caller's session. Anonymous callers,
+        and tokens that do not verify, all share one identity (None) so made up tokens cannot fill the cache.
+    """
+    if auth is None or not auth.authenticated:
+        return None
+    return [auth.tenant_id, auth.username, sorted(auth.roles or [])]
+
+
+def make_entry(value, fresh_for):
+    """ Wrap a value for storage in the cache along with the time at which it stops being fresh """
+    return {'__cached__': value, 'fresh_until': epoch() + fresh_for}
+
+
+def open_entry(entry):
+    """ Returns (value, fresh_until) for a cache entry. Bare values stored before entries were wrapped
+        have no freshness information, so they are treated as fresh until they expire.
+    """
+    if isinstance(entry, dict) and '__cached__' in entry:
+        return entry['__cached__'], entry.get('fresh_until')
+    return entry, None
+
+
+class LocalCache:
+    """ A bounded, in-process LRU cache where every entry carries its own expiry. Values are shared between
+        callers so they should be treated as read-only.
+    """
+
+    def __init__(self, max_size=DEFAULT_LOCAL_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=MISSING):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class CacheTiers:
+    """ Per-entrypoint local cache tiers and hit/miss counters, shared by every worker in this process """
+    _local = {}
+    _stats = defaultdict(Counter)
+
+    @classmethod
+    def local(cls, service_id, size):
+        if service_id not in cls._local:
+            cls._local[service_id] = LocalCache(DEFAULT_LOCAL_SIZE if size is True else int(size))
+        return cls._local[service_id]
+
+    @classmethod
+    def stats(cls, service_id):
+        return cls._stats[service_id]
+
+
+class CacheControl:
+    """ Invalidates cached results without scanning the keyspace. Every cache key includes the generation
+        counters of its service, method and tags; invalidating simply increments one of those counters so
+        that older entries are never looked up again (they fall out of Redis when their TTL is reached).
+
+        Generations are remembered in-process for GENERATION_MEMO_TIME seconds, so an invalidation made on
+        another node may take up to that long to be noticed.
+    """
+    _memo = LocalCache(max_size=4096)
+
+    def __init__(self, redis: Redis, service_name):
+        self.redis = redis
+        self.service_name = service_name
+
+    @staticmethod
+    def generation_keys(service_name, method_name=None, tags=None):
+        keys = [f'miso:cachegen:service:{service_name}']
+        if method_name:
+            keys.append(f'miso:cachegen:method:{service_name}.{method_name}')
+        for tag in force_list(tags or []):
+            keys.append(f'miso:cachegen:tag:{tag}')
+        return keys
+
+    def generations(self, keys):
+        """ Returns the current generation for each of the supplied keys """
+        missing = [key for key in keys if self._memo.get(key) is MISSING]
+        if missing:
+            for key, generation in zip(missing, self.redis.mget(missing)):
+                self._memo.set(key, int(generation or 0), GENERATION_MEMO_TIME)
+        return [self._memo.get(key, 0) for key in keys]
+
+    def invalidate(self, method=None, tag=None, service=None):
+        """ Invalidate cached results for a tag, a method or (by default) a whole service """
+        service = service or self.service_name
+        if tag is not None:
+            keys = [f'miso:cachegen:tag:{t}' for t in force_list(tag)]
+        elif method is not None:
+            keys = [f'miso:cachegen:method:{service}.{m}' for m in force_list(method)]
+        else:
+            keys = [f'miso:cachegen:service:{service}']
+
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.incr(key)
+        pipe.execute()
+        for key in keys:
+            self._memo.delete(key)
+
+
+class CacheProvider(DependencyProvider):
+    """ DependencyProvider giving services control over their cached results """
+    redis = None
+
+    def start(self):
+        self.redis = Redis.get_redis(container=self.container)
+
+    def get_dependency(self, worker_ctx):
+        return CacheControl(self.redis, worker_ctx.service_name)
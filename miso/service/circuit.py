@@ -0,0 +1,196 @@
+import time
+from collections import deque
+from logging import getLogger
+from eventlet import Timeout
+from nameko.rpc import RpcProxy
+from miso.provider.redis import Redis
+from miso.utils import Result, epoch
+
+
+LOG = getLogger('miso.service.circuit')
+SHARED_MEMO_TIME = 1
+FAILURE_REASONS = (
+    'exception in the called service', 'deadline exceeded', 'service overloaded', 'worker process crashed'
+)
+
+
+class CircuitTimeout(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """ Watches the calls made to one service method and opens (fails every call fast) once too many of the
+        recent ones failed or were slow. After reset_after seconds a single trial call is let through, which
+        closes the circuit again if it succeeds (a trial that has not finished after another reset_after seconds
+        is given up on, so a hung trial cannot keep the circuit open). With redis, an open circuit is shared by
+        every node.
+
+        failure_rate: the share of calls within the last window seconds that must fail to open the circuit
+        min_calls: the number of calls within the window needed before the circuit can open
+        slow_call: calls taking longer than this (seconds) count as failures
+    """
+    _breakers = {}
+
+    def __init__(self, name, redis=None, failure_rate=0.5, min_calls=10, window=30, reset_after=30, slow_call=None):
+        self.name = name
+        self.redis: Redis = redis
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_after = reset_after
+        self.slow_call = slow_call
+        self.calls = deque()
+        self.open_until = 0
+        self.trial = False
+        self.trial_started = 0
+        self.shared_until = 0
+        self.shared_checked = 0
+
+    @classmethod
+    def get(cls, name, **settings):
+        """ Returns the breaker for a service method, shared by every proxy in this process that uses the same
+            settings (proxies with other settings get a breaker of their own)
+        """
+        key = (name,) + tuple(sorted(settings.items(), key=lambda item: item[0]))
+        if key not in cls._breakers:
+            cls._breakers[key] = CircuitBreaker(name, **settings)
+        return cls._breakers[key]
+
+    @property
+    def shared_key(self):
+        return f'miso:circuit:{self.name}'
+
+    @property
+    def state(self):
+        if self.trial:
+            return 'half-open'
+        if self.open_until > time.monotonic() or self.shared_until > epoch():
+            return 'open'
+        return 'closed'
+
+    def check_shared(self):
+        now = time.monotonic()
+        if self.redis is not None and now - self.shared_checked > SHARED_MEMO_TIME:
+            self.shared_until = self.redis.getj(self.shared_key) or 0
+            self.shared_checked = now
+
+    def allow(self):
+        """ Whether a call may go ahead """
+        self.check_shared()
+        now = time.monotonic()
+        if self.trial and now - self.trial_started < self.reset_after:
+            return False
+        if self.shared_until > epoch():
+            return False
+        if self.open_until:
+            if self.open_until > now:
+                return False
+            # Half open, this call decides whether the circuit closes
+            self.trial = True
+            self.trial_started = now
+        return True
+
+    def open(self):
+        LOG.warning('Opening circuit for %s for %ss', self.name, self.reset_after)
+        self.open_until = time.monotonic() + self.reset_after
+        self.calls.clear()
+        if self.redis is not None:
+            self.shared_until = epoch() + self.reset_after
+            self.redis.setj(self.shared_key, self.shared_until)
+            self.redis.expire(self.shared_key, int(self.reset_after) + 1)
+
+    def close(self):
+        LOG.info('Closing circuit for %s', self.name)
+        self.open_until = self.shared_until = 0
+        self.calls.clear()
+        if self.redis is not None:
+            self.redis.delete(self.shared_key)
+
+    def record(self, ok, elapsed):
+        if self.slow_call and elapsed > self.slow_call:
+            ok = False
+        if self.trial:
+            self.trial = False
+            return self.close() if ok else self.open()
+
+        now = time.monotonic()
+        self.calls.append((now, ok))
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+        failures = sum(1 for _, call_ok in self.calls if not call_ok)
+        if len(self.calls) >= self.min_calls and failures >= self.failure_rate * len(self.calls):
+            self.open()
+
+    def call(self, func, *args, timeout=None, **kwargs):
+        """ Call func through the breaker, returns a failed Result without calling it while the circuit is open """
+        if not self.allow():
+            return Result(result=False, reason='circuit open')
+
+        started = time.monotonic()
+        ok = False
+        try:
+            with Timeout(timeout, CircuitTimeout):
+                result = func(*args, **kwargs)
+            ok = not (isinstance(result, Result) and (result.traceback or result.reason in FAILURE_REASONS))
+            return result
+        except CircuitTimeout:
+            return Result(result=False, reason='call timed out')
+        finally:
+            self.record(ok, time.monotonic() - started)
+
+
+class CircuitMethodProxy:
+    """ Calls to the method go through its breaker, anything else (e.g. call_async) goes straight to the proxy """
+
+    def __init__(self, method_proxy, breaker, timeout=None):
+        self.method_proxy = method_proxy
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def __call__(self, *args, **kwargs):
+        return self.breaker.call(self.method_proxy, *args, timeout=self.timeout, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.method_proxy, name)
+
+
+class CircuitServiceProxy:
+    def __init__(self, service_proxy, service_name, timeout=None, **settings):
+        self.service_proxy = service_proxy
+        self.service_name = service_name
+        self.timeout = timeout
+        self.settings = settings
+
+    def __getattr__(self, name):
+        breaker = CircuitBreaker.get(f'{self.service_name}.{name}', **self.settings)
+        return CircuitMethodProxy(getattr(self.service_proxy, name), breaker, self.timeout)
+
+
+class CircuitClusterProxy:
+    """ Wraps a standalone ClusterRpcProxy (once started), e.g. circuit_rpc.service.method(...) """
+
+    def __init__(self, cluster_rpc, **settings):
+        self.cluster_rpc = cluster_rpc
+        self.settings = settings
+
+    def __getattr__(self, name):
+        return CircuitServiceProxy(getattr(self.cluster_rpc, name), name, **self.settings)
+
+
+class CircuitRpcProxy(RpcProxy):
+    """ An RpcProxy whose calls fail fast with Result(result=False, reason='circuit open') while the target method
+        is unhealthy. shared=True keeps the circuit in Redis so every node stops calling it at once. timeout
+        (seconds) bounds how long a call may wait for its reply, circuit holds the CircuitBreaker settings.
+    """
+
+    def __init__(self, target_service, shared=False, timeout=None, circuit=None, **options):
+        super().__init__(target_service, **options)
+        self.shared = shared
+        self.timeout = timeout
+        self.circuit = circuit or {}
+
+    def get_dependency(self, worker_ctx):
+        redis = Redis.get_redis(container=self.container) if self.shared else None
+        return CircuitServiceProxy(
+            super().get_dependency(worker_ctx), self.target_service, timeout=self.timeout, redis=redis, **self.circuit
+        )
@@ -0,0 +1,173 @@
+import zlib
+import hashlib
+from collections.abc import Iterator
+from logging import getLogger
+from werkzeug.wrappers import Response
+from miso.encoder import dumps
+from miso.provider.redis import Redis
+from miso.service.cache import CacheControl, cache_identity, call_hash
+from miso.utils import Result, force_list
+
+
+LOG = getLogger('miso.service.http')
+DEFAULT_GZIP_THRESHOLD = 1024
+DEFAULT_GZIP_LEVEL = 6
+
+
+def split_result(result):
+    """ Returns (status_code, headers, output) for the result of an http_enhanced method """
+    if isinstance(result, tuple):
+        if len(result) == 2:
+            status_code, output = result
+            return status_code, {}, output
+        return result
+    return 200, {}, result
+
+
+def encode_output(output, pretty=False):
+    """ Results, dicts and lists become JSON: compact, or indented with sorted keys when pretty """
+    if isinstance(output, Result):
+        output = output.to_dict()
+    if isinstance(output, (dict, list)):
+        if pretty:
+            output = dumps(output, indent=2, sort_keys=True)
+        else:
+            output = dumps(output, indent=None, sort_keys=False, separators=(',', ':'))
+    if isinstance(output, str) and output[-1:] != '\n':
+        output += '\n'
+    return output
+
+
+def stream_chunks(iterator, stream=None):
+    """ Encode a streamed result one item at a time: as a JSON array with stream='json', otherwise as NDJSON
+        (one compact JSON document per line). Strings and bytes are sent as they are in NDJSON streams.
+    """
+    if stream == 'json':
+        yield '['
+        for idx, item in enumerate(iterator):
+            yield (',' if idx else '') + dumps(item, indent=None, sort_keys=False, separators=(',', ':'))
+        yield ']\n'
+    else:
+        for item in iterator:
+            if isinstance(item, (str, bytes)):
+                yield item
+            else:
+                yield dumps(item, indent=None, sort_keys=False, separators=(',', ':')) + '\n'
+
+
+def guard_stream(chunks, service_id=None):
+    """ Streamed bodies are produced while werkzeug sends the response, after the shims and the worker are done,
+        so an exception raised mid-stream is logged here. It is raised again so the connection is dropped
+        without ending the chunked response, which tells the client the body is incomplete.
+    """
+    try:
+        yield from chunks
+    except Exception:
+        LOG.exception('Streaming the response of %s failed', service_id, extra={'miso_service': service_id})
+        raise
+
+
+def gzip(body, level=DEFAULT_GZIP_LEVEL):
+    """ Gzip a body. Unlike gzip.compress the output carries no timestamp, so the same body always gives the
+        same bytes (and ETag).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def render_response(result, request=None, options=None, service_id=None):
+    """ Serialise the result of an http_enhanced method: returns (status_code, headers, body) or, for iterators,
+        a Response that streams them (chunked transfer encoding, see stream_chunks). Dicts, lists and Results are
+        sent as compact JSON, or indented with ?pretty.
+
+        A streamed body runs after the method has returned: the timeout (deadline), threaded and processes shims
+        do not cover it, and errors raised while streaming are only logged (see guard_stream).
+    """
+    status_code, headers, output = split_result(result)
+
+    if isinstance(output, Iterator):
+        stream = options.stream if options else None
+        mimetype = 'application/json' if stream == 'json' else 'application/x-ndjson'
+        chunks = guard_stream(stream_chunks(output, stream), service_id)
+        return Response(chunks, status=status_code, headers=headers, mimetype=mimetype)
+    if isinstance(output, Response):
+        headers = dict(headers, **output.headers)
+        output = output.get_data(as_text=True)
+
+    pretty = request is not None and 'pretty' in request.args
+    return status_code, dict(headers), encode_output(output, pretty).encode('utf-8')
+
+
+def finish_response(request, status_code, headers, body, options=None, settings=None):
+    """ Build the response for a serialised result:
+
+        - bodies of at least MISO_HTTP.gzip_threshold bytes are gzipped when the client accepts it
+        - successful responses carry an ETag, a matching If-None-Match gets a 304 without a body
+        - cache_time entrypoints tell clients they may reuse the response for that long (Cache-Control)
+    """
+    settings = settings or {}
+    response = Response(body, status=status_code, headers=headers)
+    if request is None or response.status_code != 200:
+        return response
+
+    threshold = settings.get('gzip_threshold', DEFAULT_GZIP_THRESHOLD)
+    if len(body) >= threshold and request.accept_encodings['gzip']:
+        response.set_data(gzip(body, settings.get('gzip_level', DEFAULT_GZIP_LEVEL)))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+
+    if options is not None and options.cache_time:
+        response.cache_control.max_age = options.cache_time
+        if options.require_auth or options.require_role or options.require_tenant:
+            response.cache_control.private = True
+
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+    return response.make_conditional(request)
+
+
+def build_response(result, request=None, options=None, settings=None):
+    """ Turn the result of an http_enhanced method into the response sent to the client """
+    rendered = render_response(result, request, options)
+    if isinstance(rendered, Response):
+        return rendered
+    return finish_response(request, *rendered, options, settings)
+
+
+class HttpCache:
+    """ Caches the serialised responses of cache_time http_enhanced entrypoints. Responses are keyed on the
+        method and path, the query parameters (only those in cache_query when given), the cache_headers request
+        headers and the caller (see cache_identity). Only 200 responses of successful results are kept, cache
+        invalidation works as it does for RPC.
+    """
+
+    def __init__(self, worker_ctx, options):
+        self.redis: Redis = worker_ctx.service.redis
+        self.cache_time = options.cache_time
+        request = worker_ctx.args[0]
+        service_name = worker_ctx.service.name
+        method_name = worker_ctx.entrypoint.method_name
+
+        if options.cache_query is None:
+            query = sorted(request.args.lists())
+        else:
+            query = [(name, request.args.getlist(name)) for name in force_list(options.cache_query)]
+        key_args = [
+            request.method, request.path, query, 'pretty' in request.args,
+            [(name, request.headers.get(name)) for name in force_list(options.cache_headers or [])]
+        ]
+        generation_keys = CacheControl.generation_keys(service_name, method_name, options.cache_tags)
+        self.cache_key = 'miso:httpcache:{}:{}'.format(service_name, call_hash(
+            f'{service_name}.{method_name}', key_args, cache_identity(getattr(worker_ctx.service, 'auth', None)),
+            CacheControl(self.redis, service_name).generations(generation_keys)
+        ))
+
+    def get(self):
+        """ Returns the cached (status_code, headers, body), or None """
+        entry = self.redis.getj(self.cache_key)
+        if entry is None:
+            return None
+        return entry['status'], entry['headers'], entry['body'].encode('utf-8')
+
+    def set(self, status_code, headers, body):
+        self.redis.setj(self.cache_key, {'status': status_code, 'headers': headers, 'body': body.decode('utf-8')})
+        self.redis.expire(self.cache_key, self.cache_time)
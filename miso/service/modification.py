@@ -1,19 +1,25 @@
 import sys
 import types
 import functools
-from nameko.containers import _log, _log_time, ServiceContainer
+from collections import Counter
+from nameko.containers import _log, _log_time, ServiceContainer, WorkerContext
 from nameko.rpc import Rpc, RpcProxy
 from nameko.timer import Timer
 from nameko.web.handlers import HttpRequestHandler
 from nameko.web.server import WebServer
 from nameko.extensions import register_entrypoint
 from werkzeug.wrappers import Response
-from miso.utils import Result
-from miso.service.shim import ShimExecutor
-from miso.encoder import dumps
+from miso.utils import Result, epoch
+from miso.service.shim import ShimExecutor, CachingShim, compile_shim_chain
+from miso.service.batch import run_batch
+from miso.service.http import HttpCache, build_response, render_response, finish_response, split_result
+from miso.service.pool import ProcessPool, ThreadPools, LanePool, process_pool_size
 from miso.state import State
 
 
+MAX_REQUEST_TIMEOUT = 300
+
+
 class MisoOverrideOptions:
     require_auth = None
     require_role = None
@@ -21,9 +27,27 @@ class MisoOverrideOptions:
     force_res_object = True
     cache_time = 0
     cache_allow_override = None
+    cache_coalesce = None
+    cache_local = None
+    cache_stale_time = None
+    cache_refresh_ahead = None
+    cache_tags = None
+    cache_negative_time = None
+    cache_key = None
     threaded = None
+    processes = None
     master_only = False
     sudo = None
+    timeout = None
+    rate_limit = None
+    rate_limit_by = None
+    max_concurrency = None
+    lane = None
+    batch = None
+    batch_of = None
+    stream = None
+    cache_query = None
+    cache_headers = None
 
     def __repr__(self):
         options = ' '.join(f'{p}={getattr(self, p)}' for p in dir(self) if not p.startswith('_'))
@@ -31,6 +55,16 @@ class MisoOverrideOptions:
 
 
 class MisoEntrypointModifications:
+    miso_http = False
+    miso_options = None
+    miso_shims = None
+
+    def setup(self):
+        """ Resolve the options and shim chain for this entrypoint once, when the container starts """
+        super().setup()
+        self.miso_options = getattr(self.container.service_cls, self.method_name)._miso_options
+        self.miso_shims = compile_shim_chain(self.miso_options)
+
     @classmethod
     def decorator(cls, *args, **kwargs):
         def register_miso_entrypoint(fn, args, kwargs, cls):
@@ -55,6 +89,36 @@ class MisoEntrypointModifications:
     def entrypoint_kwargs(self):
         return {p: getattr(self, p) for p in dir(MisoEntrypointModifications) if not p.startswith('_')}
 
+
+def batch_entrypoint(name, options):
+    """ Build the <name>_many(items) entrypoint for a batch=True method. Auth, rate limits, deadlines, threading
+        etc. apply once to the whole batch, caching applies to each item (see BatchShim).
+    """
+    def many(self, items):
+        return run_batch(self, name, items)
+
+    many.__name__ = many.__qualname__ = f'{name}_many'
+    many.__doc__ = f'Calls {name} for every item of a batch, returns one result per item'
+    batch_options = {
+        p: getattr(options, p) for p in dir(MisoOverrideOptions)
+        if not p.startswith('_') and not p.startswith('cache_') and p not in ('batch', 'batch_of', 'force_res_object')
+    }
+    return rpc_enhanced(batch_of=name, force_res_object=False, **batch_options)(many)
+
+
+def request_timeout(value):
+    """ The X-Request-Timeout header in seconds, at most MAX_REQUEST_TIMEOUT. Missing, malformed, zero and
+        negative values are ignored (the request has no deadline).
+    """
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not timeout > 0:  # Also rejects NaN
+        return None
+    return min(timeout, MAX_REQUEST_TIMEOUT)
+
+
 class MisoWebServer(WebServer):
     def __init__(self):
         super().__init__()
@@ -64,17 +128,53 @@ class MisoWebServer(WebServer):
         return WebServer
 
     def context_data_from_headers(self, request):
-        return {
+        context_data = {
             'miso_auth_token': request.headers.get('X-Auth-Token', None)
         }
+        timeout = request_timeout(request.headers.get('X-Request-Timeout'))
+        if timeout:
+            context_data['miso_deadline'] = epoch() + timeout
+        return context_data
 
 
 class MisoHttpRequestHandler(MisoEntrypointModifications, HttpRequestHandler):
+    miso_http = True
     server = MisoWebServer()
 
     def __init__(self, method, url, **kwargs):
         super().__init__(method, url, **kwargs)
 
+    def setup(self):
+        super().setup()
+        # Responses are cached whole (see HttpCache), the Request argument makes call based caching useless
+        self.miso_shims = tuple(shim for shim in self.miso_shims if shim is not CachingShim)
+
+    def miso_call(self, method, worker_ctx):
+        """ Run the method through its shims and build the response, or answer from the response cache """
+        request = worker_ctx.args[0]
+        cache = HttpCache(worker_ctx, self.miso_options) if self.miso_options.cache_time else None
+        rendered = cache.get() if cache is not None else None
+        if rendered is None:
+            result = ShimExecutor(method, worker_ctx, self.miso_shims).apply()
+            service_id = f'{worker_ctx.service.name}.{method.__name__}'
+            rendered = render_response(result, request, self.miso_options, service_id)
+            # Failed Results are sent as 200s too, like RPC caching they are never stored
+            if (
+                cache is not None and isinstance(rendered, tuple) and rendered[0] == 200 and
+                not CachingShim.is_failure(split_result(result)[2])
+            ):
+                cache.set(*rendered)
+        else:
+            _log.debug('answered %s from the response cache', worker_ctx)
+
+        if isinstance(rendered, Response):
+            return rendered
+        return finish_response(request, *rendered, self.miso_options, self.container.config.get('MISO_HTTP'))
+
+    def miso_response(self, result, request=None):
+        """ Convert the result of an enhanced entrypoint to the response sent to the client (see build_response) """
+        return build_response(result, request, self.miso_options, self.container.config.get('MISO_HTTP'))
+
 
 class MisoRpc(MisoEntrypointModifications, Rpc):
     pass
@@ -85,7 +185,21 @@ class MisoTimer(MisoEntrypointModifications, Timer):
 
 
 class MisoServiceContainer(ServiceContainer):
+    """ Adds admission control to nameko's container: a call is shed at once (a failed Result over RPC, a 503
+        over HTTP) when its entrypoint already has max_concurrency calls in flight, when its lane is full (see
+        LanePool) or when MISO_MAX_QUEUE calls are already waiting for one of the max_workers workers.
+        Shed calls are counted in miso_rejections.
+    """
     _miso_state = None
+    miso_process_pool = None
+    miso_thread_pools = None
+
+    def __init__(self, service_cls, config):
+        super().__init__(service_cls, config)
+        self.max_queue = config.get('MISO_MAX_QUEUE')
+        self._worker_pool = LanePool(self.max_workers, config.get('MISO_LANES'))
+        self.miso_in_flight = Counter()
+        self.miso_rejections = Counter()
 
     @property
     def miso_state(self):
@@ -93,6 +207,69 @@ class MisoServiceContainer(ServiceContainer):
             self._miso_state = State.get_state(config=self.config)
         return self._miso_state
 
+    def start(self):
+        self.miso_thread_pools = ThreadPools(self.config)
+        self.miso_thread_pools.reserve(self.service_cls)
+        pool_size = process_pool_size(self.service_cls, self.config)
+        if pool_size:
+            self.miso_process_pool = ProcessPool(pool_size, preload=[self.service_cls.__module__])
+            self.miso_process_pool.start()
+        super().start()
+
+    def stop(self):
+        super().stop()
+        self._stop_miso_pools()
+
+    def kill(self, exc_info=None):
+        super().kill(exc_info)
+        self._stop_miso_pools()
+
+    def _stop_miso_pools(self):
+        if self.miso_thread_pools is not None:
+            self.miso_thread_pools.release()
+        if self.miso_process_pool is not None:
+            self.miso_process_pool.stop()
+
+    def spawn_worker(self, entrypoint, args, kwargs, context_data=None, handle_result=None):
+        reason = self._miso_admission(entrypoint)
+        if reason is None:
+            # Counted before spawning, which may wait for a worker, so that waiting calls count towards the limit
+            self.miso_in_flight[entrypoint.method_name] += 1
+            try:
+                return super().spawn_worker(entrypoint, args, kwargs, context_data, handle_result)
+            except BaseException:
+                self.miso_in_flight[entrypoint.method_name] -= 1
+                raise
+
+        self.miso_rejections[f'{self.service_name}.{entrypoint.method_name}'] += 1
+        _log.warning('shedding call to %s.%s: %s', self.service_name, entrypoint.method_name, reason)
+        worker_ctx = WorkerContext(self, self.service_cls(), entrypoint, args, kwargs, data=context_data)
+        if handle_result is not None:
+            result = Result(result=False, reason='service overloaded')
+            if isinstance(entrypoint, MisoHttpRequestHandler):
+                result = entrypoint.miso_response((503, {'Retry-After': '1'}, result), args[0])
+            handle_result(worker_ctx, result, None)
+        return worker_ctx
+
+    def _miso_admission(self, entrypoint):
+        """ Returns the reason to shed a new call to the entrypoint (None if it can run) """
+        options = getattr(entrypoint, 'miso_options', None)
+        in_flight = self.miso_in_flight[entrypoint.method_name]
+        if options and options.max_concurrency and in_flight >= options.max_concurrency:
+            return f'{options.max_concurrency} calls already in flight'
+        if options and options.lane:
+            if self._worker_pool.lane(options.lane).full:
+                return f'lane {options.lane} is full'
+        elif (
+            self.max_queue is not None and self._worker_pool.free() <= 0 and
+            self._worker_pool.waiting >= self.max_queue
+        ):
+            return f'{self.max_queue} calls already waiting for a worker'
+
+    def _handle_worker_thread_exited(self, gt, worker_ctx):
+        self.miso_in_flight[worker_ctx.entrypoint.method_name] -= 1
+        super()._handle_worker_thread_exited(gt, worker_ctx)
+
     def _run_worker(self, worker_ctx, handle_result):
         _log.debug('enhancing call to %s.%s', worker_ctx.service.name, worker_ctx.entrypoint.method_name)
         _log.debug('setting up %s', worker_ctx)
@@ -106,32 +283,10 @@ class MisoServiceContainer(ServiceContainer):
             method_name = worker_ctx.entrypoint.method_name
             method = getattr(worker_ctx.service, method_name)
 
-            if isinstance(worker_ctx.entrypoint, MisoEntrypointModifications):
-                result = ShimExecutor(method, worker_ctx).apply()
-
-                # Convert any results from enhanced entrypoints to JSON if possible
-                if isinstance(worker_ctx.entrypoint, MisoHttpRequestHandler):
-                    status_code, headers = 200, {}
-
-                    if isinstance(result, tuple):
-                        if len(result) == 2:
-                            status_code, output = result
-                        else:
-                            status_code, headers, output = result
-                    else:
-                        output = result
-
-                    if isinstance(output, Response):
-                        headers.update(output.headers)
-                        output = output.get_data(as_text=True)
-                    if isinstance(output, Result):
-                        output = output.to_dict()
-                    if isinstance(output, (dict, list)):
-                        output = dumps(output, indent=2, sort_keys=True)
-                    if isinstance(output, str) and output[-1] != '\n':
-                        output += '\n'
-
-                    result = status_code, headers, output
+            if isinstance(worker_ctx.entrypoint, MisoHttpRequestHandler):
+                result = worker_ctx.entrypoint.miso_call(method, worker_ctx)
+            elif isinstance(worker_ctx.entrypoint, MisoEntrypointModifications):
+                result = ShimExecutor(method, worker_ctx, worker_ctx.entrypoint.miso_shims).apply()
             else:
                 try:
                     _log.debug('calling handler for %s', worker_ctx)
@@ -0,0 +1,343 @@
+import os
+import sys
+import time
+import socket
+import inspect
+import importlib
+import subprocess
+import traceback
+from logging import getLogger
+from eventlet import tpool, spawn, spawn_n, GreenPool
+from eventlet.queue import LightQueue
+from eventlet.semaphore import Semaphore
+from miso.encoder import dumps, loads
+
+
+LOG = getLogger('miso.service.pool')
+DEFAULT_THREAD_POOL = 'default'
+DEFAULT_THREAD_POOL_SIZE = 4
+DEFAULT_TPOOL_SIZE = 20  # eventlet's own default when EVENTLET_THREADPOOL_SIZE is not set
+READY = 'ready'
+WORKER_COMMAND = 'import sys; from miso.service.pool import worker_main; worker_main(int(sys.argv[1]), sys.argv[2:])'
+
+
+def entrypoint_options(service_cls):
+    """ Yields the miso options of every enhanced entrypoint on a service class """
+    for _, method in inspect.getmembers(service_cls, inspect.isfunction):
+        options = getattr(method, '_miso_options', None)
+        if options is not None:
+            yield options
+
+
+def process_pool_size(service_cls, config):
+    """ Returns the number of processes needed by the entrypoints of a service (0 if none run in a process) """
+    size = 0
+    for options in entrypoint_options(service_cls):
+        if options.processes:
+            size = max(size, options.processes)
+        elif options.threaded == 'process':
+            size = max(size, config.get('MISO_PROCESS_POOL_SIZE') or os.cpu_count() or 1)
+    return size
+
+
+def thread_pool_name(options):
+    """ Returns the name of the thread pool used by an entrypoint (None if it does not run in a thread) """
+    if options.threaded is True:
+        return DEFAULT_THREAD_POOL
+    if isinstance(options.threaded, str) and options.threaded != 'process' and not options.processes:
+        return options.threaded
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    """ The method raised an exception inside the worker process (the message is the remote traceback) """
+    pass
+
+
+def encode(obj):
+    return dumps(obj, sort_keys=False, indent=None) + '\n'
+
+
+def worker_main(fileno, preload):
+    """ Entry point of a pool process. Reads one request per line from the socket it was given and writes one
+        response per line back, both encoded with the betterjson codec. Service instances are bare: dependencies
+        (redis, auth, ...) are not available to the method, only its arguments and self.logger.
+    """
+    sock = socket.socket(fileno=fileno)
+    sock.setblocking(True)  # The parent's (green) socket pair is non-blocking
+    channel = sock.makefile('rw', encoding='utf-8')
+    for module_name in preload:
+        importlib.import_module(module_name)
+    channel.write(encode(READY))
+    channel.flush()
+
+    for line in channel:
+        request = loads(line)
+        try:
+            service_cls = getattr(importlib.import_module(request['module']), request['class'])
+            service = service_cls.__new__(service_cls)
+            service.logger = getLogger(f'miso.service.{service_cls.name}')
+            response = {'result': getattr(service, request['method'])(*request['args'], **request['kwargs'])}
+        except Exception:
+            response = {'error': traceback.format_exc()}
+        channel.write(encode(response))
+        channel.flush()
+
+
+class PoolProcess:
+    """ A single worker process, talked to over a socket pair (a dead worker reliably shows up as a closed
+        connection, where writing to a dead process's stdin can block the hub)
+    """
+    def __init__(self, preload):
+        parent_sock, child_sock = socket.socketpair()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        self.proc = subprocess.Popen(
+            [sys.executable, '-c', WORKER_COMMAND, str(child_sock.fileno())] + list(preload),
+            pass_fds=[child_sock.fileno()], env=env
+        )
+        child_sock.close()
+        self.sock = parent_sock
+        self.channel = parent_sock.makefile('rw', encoding='utf-8')
+
+    def receive(self):
+        line = self.channel.readline()
+        if not line:
+            raise WorkerCrashed(f'worker process {self.proc.pid} exited with {self.proc.poll()}')
+        return loads(line)
+
+    def request(self, request):
+        try:
+            self.channel.write(encode(request))
+            self.channel.flush()
+        except OSError:
+            raise WorkerCrashed(f'worker process {self.proc.pid} is not accepting requests')
+        return self.receive()
+
+    def stop(self):
+        try:
+            self.channel.close()
+            self.sock.close()
+            self.proc.wait(timeout=5)
+        except Exception:  # noqa: E722 (a worker that will not exit cleanly gets killed)
+            self.proc.kill()
+
+
+class ThreadPool:
+    """ A named, sized share of eventlet's tpool. Callers beyond the pool's size wait (cooperatively) for a slot,
+        so one slow blocking entrypoint can only ever hold its own pool's threads.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.slots = Semaphore(size)
+        self.waiting = 0
+
+    def execute(self, func, *args, **kwargs):
+        """ Run func in a thread, returns its result and the time spent waiting for a slot """
+        self.waiting += 1
+        queued = time.monotonic()
+        try:
+            self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - queued
+        ThreadPools.tpool_started = True
+        try:
+            return tpool.execute(func, *args, **kwargs), waited
+        finally:
+            self.slots.release()
+
+
+class ThreadPools:
+    """ The thread pools of a container, sized by the MISO_THREAD_POOLS config section:
+
+        MISO_THREAD_POOLS:
+            default: 10   # threaded=True
+            reports: 2    # threaded='reports'
+
+        Pools that are not configured get DEFAULT_THREAD_POOL_SIZE threads. eventlet's tpool is sized to fit
+        every pool before it is first used, afterwards it keeps its size (set EVENTLET_THREADPOOL_SIZE instead).
+    """
+    _reserved = 0  # Threads reserved across every container in this process
+    tpool_size = int(os.environ.get('EVENTLET_THREADPOOL_SIZE', DEFAULT_TPOOL_SIZE))
+    tpool_started = False
+
+    def __init__(self, config):
+        self.sizes = config.get('MISO_THREAD_POOLS') or {}
+        self.pools = {}
+        self.reserved = 0
+
+    def size_of(self, name):
+        return int(self.sizes.get(name, DEFAULT_THREAD_POOL_SIZE))
+
+    def reserve(self, service_cls):
+        """ Make sure eventlet's tpool has enough threads for every pool used by the service """
+        names = {thread_pool_name(options) for options in entrypoint_options(service_cls)} - {None}
+        self.reserved = sum(self.size_of(name) for name in names)
+        ThreadPools._reserved += self.reserved
+        if ThreadPools._reserved > ThreadPools.tpool_size:
+            if ThreadPools.tpool_started:
+                LOG.warning(
+                    'tpool has %s threads, thread pools need %s (set EVENTLET_THREADPOOL_SIZE)',
+                    ThreadPools.tpool_size, ThreadPools._reserved
+                )
+            else:
+                tpool.set_num_threads(ThreadPools._reserved)
+                ThreadPools.tpool_size = ThreadPools._reserved
+
+    def release(self):
+        ThreadPools._reserved -= self.reserved
+        self.reserved = 0
+
+    def get(self, name):
+        if name not in self.pools:
+            self.pools[name] = ThreadPool(name, self.size_of(name))
+        return self.pools[name]
+
+
+class ProcessPool:
+    """ A persistent, pre-warmed pool of worker processes for CPU bound entrypoints. Each worker runs one
+        method at a time, callers wait (cooperatively) for an idle worker.
+    """
+
+    def __init__(self, size, preload=()):
+        self.size = size
+        self.preload = preload
+        self.idle = LightQueue()
+        self.workers = []
+
+    def spawn(self):
+        worker = PoolProcess(self.preload)
+        if worker.receive() != READY:
+            raise WorkerCrashed('worker process failed to start')
+        self.workers.append(worker)
+        self.idle.put(worker)
+
+    def start(self):
+        LOG.info('Starting process pool with %s workers', self.size)
+        for _ in range(self.size):
+            self.spawn()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def replace(self, worker):
+        worker.proc.kill()
+        worker.stop()
+        self.workers.remove(worker)
+        self.spawn()
+
+    def execute(self, method, args, kwargs):
+        """ Run a (bound) service method in a worker process and return its result """
+        service_cls = type(method.__self__)
+        worker = self.idle.get()
+        try:
+            response = worker.request({
+                'module': service_cls.__module__,
+                'class': service_cls.__name__,
+                'method': method.__name__,
+                'args': list(args),
+                'kwargs': kwargs
+            })
+        except WorkerCrashed:
+            LOG.error('A worker process died while running %s.%s', service_cls.name, method.__name__)
+            self.replace(worker)
+            raise
+        except BaseException:
+            # Interrupted (e.g. by a deadline) mid-request, the worker is still busy with it so start afresh
+            spawn_n(self.replace, worker)
+            raise
+        self.idle.put(worker)
+
+        if 'error' in response:
+            raise WorkerError(response['error'])
+        return response['result']
+
+
+class Lane:
+    """ A bounded share of a container's workers. Calls beyond the lane's size wait in their own green thread
+        for a free slot (never in the thread that received them), so a full lane does not hold up other calls.
+        At most queue calls may wait, see full.
+    """
+
+    def __init__(self, name, size, queue=0):
+        self.name = name
+        self.size = size
+        self.queue = queue
+        self.slots = Semaphore(size)
+        self.threads = set()
+
+    @property
+    def full(self):
+        """ Whether a new call would have to wait beyond the lane's queue (and should be shed instead) """
+        return len(self.threads) >= self.size + self.queue
+
+    def run(self, function, *args, **kwargs):
+        with self.slots:
+            return function(*args, **kwargs)
+
+    def spawn(self, function, *args, **kwargs):
+        gt = spawn(self.run, function, *args, **kwargs)
+        self.threads.add(gt)
+        gt.link(lambda thread: self.threads.discard(thread))
+        return gt
+
+    def waitall(self):
+        for gt in list(self.threads):
+            gt.wait()
+
+
+class LanePool(GreenPool):
+    """ The worker pool of a container, with a separate lane for entrypoints with lane='slow' (or any other name).
+        Calls in a lane only ever take that lane's workers, so they cannot starve the rest of the service. Lanes are
+        sized by the MISO_LANES config section, either as a size or as a size and a queue (which defaults to the
+        size):
+
+        MISO_LANES:
+            slow: 2   # lane='slow'
+            reports:
+                size: 1
+                queue: 3
+
+        A call waiting for a lane still holds one of the container's max_workers RPC messages (the AMQP prefetch),
+        so calls beyond size + queue are shed by the container. Lanes are capped to always leave at least one of
+        max_workers free for the entrypoints outside them.
+    """
+
+    def __init__(self, size, lanes=None):
+        super().__init__(size)
+        self.lane_sizes = lanes or {}
+        self.lanes = {}
+        self.waiting = 0  # Callers blocked in spawn until one of the pool's workers is free
+
+    def lane(self, name):
+        if name not in self.lanes:
+            settings = self.lane_sizes.get(name, self.size)
+            if not isinstance(settings, dict):
+                settings = {'size': settings}
+            capacity = max(1, self.size - 1)
+            size = min(int(settings.get('size', self.size)), capacity)
+            queue = min(int(settings.get('queue', size)), capacity - size)
+            self.lanes[name] = Lane(name, size, queue)
+        return self.lanes[name]
+
+    def spawn(self, function, worker_ctx, *args, **kwargs):
+        options = getattr(worker_ctx.entrypoint, 'miso_options', None)
+        if options is not None and options.lane:
+            return self.lane(options.lane).spawn(function, worker_ctx, *args, **kwargs)
+        self.waiting += 1
+        try:
+            return super().spawn(function, worker_ctx, *args, **kwargs)
+        finally:
+            self.waiting -= 1
+
+    def waitall(self):
+        super().waitall()
+        for lane in self.lanes.values():
+            lane.waitall()
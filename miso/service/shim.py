@@ -1,27 +1,65 @@
+import time
 from uuid import uuid4
+from types import SimpleNamespace
+from collections.abc import Iterator
 from logging import getLogger
-from eventlet import tpool
-from miso.encoder import dumps
+from eventlet import sleep, spawn_n, tpool, Timeout
+from redis.exceptions import LockError
 from miso.provider.auth import Auth
 from miso.provider.redis import Redis
-from miso.utils import Result, comma_join, force_list, md5sum
+from miso.service.pool import WorkerCrashed, thread_pool_name
+from miso.service.batch import item_arguments
+from miso.service.cache import (
+    CacheTiers, CacheControl, MISSING, make_entry, open_entry, key_arguments, call_hash, cache_identity
+)
+from miso.utils import Result, comma_join, force_list, epoch
 from werkzeug.wrappers import Response
 
 
+LOG = getLogger('miso.service')
+COALESCE_LOCK_TIME = 30
+COALESCE_POLL_INTERVAL = 0.05
+DEADLINE_KEY = 'miso_deadline'
+
+
+def compile_shim_chain(options):
+    """ Work out which shims apply to an entrypoint with the given options. This is done once per entrypoint
+        (when the container starts) so that calls only need to construct the shims they actually use.
+    """
+    return tuple(shim for shim in Shim.__subclasses__() if shim.applies_to(options))
+
+
+def as_result(value):
+    """ Wrap anything that is not already a result (or an HTTP response or stream) in a Result """
+    if isinstance(value, (tuple, Response, Result, Iterator)):
+        return value
+    if isinstance(value, bool):
+        return Result(result=value)
+    return Result(result=True, data=value)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
 class ShimExecutor:
-    shim = []
     stop_executing = False
     result = None
 
-    def __init__(self, method, worker_ctx):
-        self.logger = getLogger('miso.service')
+    def __init__(self, method, worker_ctx, shim_chain=None):
+        self.logger = LOG
         self.method = method
         self.options = self.method._miso_options
         self.entrypoint = worker_ctx.entrypoint
         self.worker_ctx = worker_ctx
         self.service_id = f'{worker_ctx.service.name}.{method.__name__}'
         self.execution_id = str(uuid4())
-        self.shims = [shim(self) for shim in Shim.__subclasses__() if shim.enabled]
+        if shim_chain is None:
+            shim_chain = compile_shim_chain(self.options)
+        if DeadlineShim not in shim_chain and worker_ctx.context_data.get(DEADLINE_KEY):
+            # The caller is working to a deadline, so we are too
+            shim_chain = (DeadlineShim,) + tuple(shim_chain)
+        self.shims = [shim(self) for shim in shim_chain]
 
     @property
     def log_extra(self):
@@ -36,8 +74,6 @@ class ShimExecutor:
     def shim_lines(self):
         parts = []
         for shim in self.shims:
-            if not shim.enabled:
-                continue
             from_log = []
             for k, v in shim.log_extra().items():
                 from_log.append(f'{k}={v}')
@@ -50,20 +86,27 @@ class ShimExecutor:
     def call(self):
         return self.method(*self.worker_ctx.args, **self.worker_ctx.kwargs)
 
+    def execute(self):
+        """ Run the method the same way a call would, in a thread or process when the entrypoint asks for it """
+        for shim in self.shims:
+            if isinstance(shim, ThreadingShim):
+                return shim.run()
+        return self.call()
+
     def apply(self):
         self.logger.info(f'Call to {self.service_id} ({self.execution_id}) started', extra=self.log_extra)
 
         for shim in self.shims:
-            if shim.enabled:
-                shim.pre_call()
+            if self.stop_executing:
+                break
+            shim.pre_call()
 
         try:
             for shim in self.shims:
                 if self.stop_executing:
                     # self.logger.debug('no longer doing pre_execute()s due to stop_executing')
                     break
-                if shim.enabled:
-                    shim.pre_execute()
+                shim.pre_execute()
 
             for shim in self.shims:
                 if self.stop_executing or shim.alternate_execute():
@@ -75,15 +118,19 @@ class ShimExecutor:
                 if self.stop_executing:
                     # self.logger.debug('no longer doing post_execute()s due to stop_executing')
                     break
-                if shim.enabled:
-                    shim.post_execute()
+                shim.post_execute()
+        except DeadlineExceeded:
+            self.logger.error('deadline exceeded', extra=self.log_extra)
+            self.result = Result(result=False, reason='deadline exceeded')
         except:  # noqa: E722
             self.logger.exception('service raised an exception!', extra=self.log_extra)
             self.result = Result(result=False, reason='exception in the called service')
+        finally:
+            for shim in reversed(self.shims):
+                shim.end_execute()
 
         for shim in reversed(self.shims):
-            if shim.enabled:
-                shim.post_call()
+            shim.post_call()
 
         self.logger.info(
             f'Call to {self.service_id} ({self.execution_id}) ended: ({self.shim_lines()})', extra=self.log_extra
@@ -94,12 +141,17 @@ class ShimExecutor:
 
 class Shim:
     name = None
-    enabled = False
+    enabled = True
 
     def __init__(self, override):
         self.override = override
         self.logger = override.logger
 
+    @classmethod
+    def applies_to(cls, options):
+        """ Returns true if this shim should be part of the chain for an entrypoint with these options """
+        return False
+
     def __repr__(self):
         return f'<{self.__class__.__name__}(enabled={self.enabled})>'
 
@@ -115,6 +167,10 @@ class Shim:
     def post_execute(self):
         pass
 
+    def end_execute(self):
+        """ Always called once execution has finished, failed or been skipped """
+        pass
+
     def alternate_execute(self):
         return False
 
@@ -133,9 +189,52 @@ class Shim:
         self.override.stop_executing = True
 
 
+class DeadlineShim(Shim):
+    """ Bounds how long a call may run. The deadline (an epoch) is the earlier of the caller's deadline and our
+        own timeout option, it is kept in the context data so that nested RPC calls inherit what is left of it.
+    """
+    name = 'deadline'
+    timer = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # context_data is a copy, the worker's own data is what nested RPC calls are sent
+        data = self.override.worker_ctx.data
+        deadlines = []
+        if data.get(DEADLINE_KEY):
+            deadlines.append(float(data[DEADLINE_KEY]))
+        if self.override.options.timeout:
+            deadlines.append(epoch() + self.override.options.timeout)
+        self.deadline = min(deadlines)
+        data[DEADLINE_KEY] = self.deadline
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.timeout)
+
+    @property
+    def remaining(self):
+        return self.deadline - epoch()
+
+    def log_extra(self):
+        return {
+            'remaining_ms': round(self.remaining * 1000)
+        }
+
+    def pre_call(self):
+        if self.remaining <= 0:
+            self.set_fail('deadline exceeded')
+
+    def pre_execute(self):
+        self.timer = Timeout(max(self.remaining, 0), DeadlineExceeded(self.override.service_id))
+
+    def end_execute(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
 class AuthShim(Shim):
     name = 'auth'
-    enabled = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -145,7 +244,10 @@ class AuthShim(Shim):
         self.require_tenant = self.override.options.require_tenant
         self.sudo = self.override.options.sudo
         self.check_auth = bool(self.require_auth or self.require_role or self.require_tenant)
-        self.enabled = self.sudo or self.check_auth
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.sudo or options.require_auth or options.require_role or options.require_tenant)
 
     def log_extra(self):
         return {
@@ -182,33 +284,118 @@ class AuthShim(Shim):
                 self.logger.error(f'authentication failure in service: %s', ','.join(issues.keys()))
 
 
+class RateLimitShim(Shim):
+    """ Enforces rate_limit=(calls, seconds) using a token bucket in Redis, so the limit holds across every node.
+        rate_limit_by chooses who the limit applies to: 'caller' (default), 'tenant' or 'entrypoint'.
+    """
+    name = 'ratelimit'
+    limited = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.redis: Redis = getattr(self.override.worker_ctx.service, 'redis', None)
+        self.auth: Auth = getattr(self.override.worker_ctx.service, 'auth', None)
+        self.calls, self.per = self.override.options.rate_limit
+        self.limit_by = self.override.options.rate_limit_by or 'caller'
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.rate_limit)
+
+    @property
+    def bucket(self):
+        if self.limit_by == 'entrypoint':
+            subject = '*'
+        elif self.limit_by == 'tenant':
+            subject = (self.auth and self.auth.tenant_id) or 'nobody'
+        else:
+            subject = self.auth.whoami() if self.auth else 'nobody'
+        return f'miso:ratelimit:{self.override.service_id}:{subject}'
+
+    def log_extra(self):
+        return {
+            'limited': int(self.limited)
+        }
+
+    def pre_call(self):
+        rate = self.calls / self.per
+        allowed, tokens = self.redis.take_token(self.bucket, self.calls, rate)
+        if allowed:
+            return
+
+        self.limited = True
+        retry_after = max(1, round((1 - tokens) / rate))
+        if getattr(self.override.entrypoint, 'miso_http', False):
+            self.set_result((429, {'Retry-After': str(retry_after)}, {
+                'result': False, 'reason': 'rate limit exceeded'
+            }), stop_executing=True)
+        else:
+            self.set_fail('rate limit exceeded')
+
+
 class ThreadingShim(Shim):
     name = 'thread'
-    enabled = True
+    pool = None
+    queue_depth = 0
+    wait_time = 0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.enabled = self.override.options.threaded is True
+        self.in_process = bool(self.override.options.processes or self.override.options.threaded == 'process')
+        # A plain nameko ServiceContainer has no thread pools, calls then go straight to eventlet's tpool
+        thread_pools = getattr(self.override.worker_ctx.container, 'miso_thread_pools', None)
+        if not self.in_process and thread_pools is not None:
+            self.pool = thread_pools.get(thread_pool_name(self.override.options))
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.threaded or options.processes)
+
+    def run(self):
+        worker_ctx = self.override.worker_ctx
+        if self.in_process:
+            return worker_ctx.container.miso_process_pool.execute(
+                self.override.method, worker_ctx.args, worker_ctx.kwargs
+            )
+        if self.pool is None:
+            return tpool.execute(self.override.call)
+        self.queue_depth = self.pool.waiting
+        result, self.wait_time = self.pool.execute(self.override.call)
+        return result
 
     def alternate_execute(self):
-        if self.enabled:
-            self.set_result(tpool.execute(self.override.call), stop_executing=True)
-            return True
-        return False
+        try:
+            self.set_result(self.run(), stop_executing=True)
+        except WorkerCrashed:
+            self.set_fail('worker process crashed')
+        return True
 
     def log_extra(self):
+        if self.in_process:
+            return {'threaded': 'process'}
+        if self.pool is None:
+            return {'threaded': 1}
         return {
-            'threaded': int(self.enabled)
+            'threaded': 1,
+            'thread_pool': self.pool.name,
+            'queue_depth': self.queue_depth,
+            'wait_ms': round(self.wait_time * 1000, 2)
         }
 
 
 class CachingShim(Shim):
     name = 'cache'
-    enabled = True
     call_hash = None
     cache_key = None
     retrieved = False
     stored = False
+    coalesced = False
+    lock = None
+    local = None
+    tier = None
+    stale = False
+    refreshing = False
+    negative = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -216,47 +403,258 @@ class CachingShim(Shim):
         self.auth: Auth = getattr(self.override.worker_ctx.service, 'auth', None)
         self.cache_time = self.override.options.cache_time
         self.cache_allow_override = self.override.options.cache_allow_override
-        self.enabled = bool(self.cache_time or self.cache_allow_override)
-        if self.enabled:
-            self.call_hash = md5sum(dumps({
-                'service_id': self.override.service_id,
-                'args': self.override.worker_ctx.args,
-                'kwargs': self.override.worker_ctx.kwargs,
-                'username': self.auth.username,
-                'teant_id': self.auth.tenant_id
-            }))
-            self.cache_key = f'miso:cache:{self.override.worker_ctx.service.name}:{self.call_hash}'
+        self.cache_coalesce = self.override.options.cache_coalesce
+        self.cache_stale_time = self.override.options.cache_stale_time
+        self.cache_refresh_ahead = self.override.options.cache_refresh_ahead
+        self.cache_negative_time = self.override.options.cache_negative_time
+        self.cache_ttl = (self.cache_time or 0) + (self.cache_stale_time or 0)
+        self.stats = CacheTiers.stats(self.override.service_id)
+        if self.override.options.cache_local and self.cache_time:
+            self.local = CacheTiers.local(self.override.service_id, self.override.options.cache_local)
+        service_name = self.override.worker_ctx.service.name
+        generation_keys = CacheControl.generation_keys(
+            service_name, self.override.method.__name__, self.override.options.cache_tags
+        )
+        self.call_hash = call_hash(
+            self.override.service_id,
+            key_arguments(
+                self.override.method, self.override.options.cache_key,
+                self.override.worker_ctx.args, self.override.worker_ctx.kwargs
+            ),
+            cache_identity(self.auth),
+            CacheControl(self.redis, service_name).generations(generation_keys)
+        )
+        self.cache_key = f'miso:cache:{service_name}:{self.call_hash}'
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.cache_time or options.cache_allow_override)
 
     def log_extra(self):
-        return {
+        extra = {
             'from_cache': int(self.retrieved),
-            'to_cache': int(self.stored)
+            'to_cache': int(self.stored),
+            'coalesced': int(self.coalesced),
+            'cache_tier': self.tier or '',
+            'stale': int(self.stale),
+            'refreshing': int(self.refreshing),
+            'negative': int(self.negative),
+            'redis_hits': self.stats['redis_hits'],
+            'redis_misses': self.stats['redis_misses']
         }
+        if self.local is not None:
+            extra.update(local_hits=self.stats['local_hits'], local_misses=self.stats['local_misses'])
+        return extra
+
+    def lookup(self):
+        """ Returns the cache entry for this call, trying the local tier before Redis """
+        if self.local is not None:
+            entry = self.local.get(self.cache_key)
+            if entry is not MISSING:
+                self.stats['local_hits'] += 1
+                return 'local', entry
+            self.stats['local_misses'] += 1
+            entry, ttl = self.redis.getj_ttl(f'{self.cache_key}:data')
+            if entry is not None:
+                self.local.set(self.cache_key, entry, min(ttl or self.cache_ttl, self.cache_ttl))
+        else:
+            entry = self.redis.getj(f'{self.cache_key}:data')
+
+        if entry is None:
+            self.stats['redis_misses'] += 1
+            return None, None
+        self.stats['redis_hits'] += 1
+        return 'redis', entry
+
+    def retrieve(self):
+        """ Use the cached result for this call if there is one. Stale results (or those close to expiring when
+            refreshing ahead) are still used, but a background refresh is started.
+        """
+        tier, entry = self.lookup()
+        if entry is None:
+            return False
+
+        # Entries are wrapped, so a cached empty result (None, False, 0, []) is still a hit
+        cached_data, fresh_until = open_entry(entry)
+        self.set_result(cached_data, stop_executing=True)
+        self.retrieved = True
+        self.negative = self.is_failure(cached_data)
+        self.tier = tier
+        if fresh_until is not None and (self.cache_stale_time or self.cache_refresh_ahead):
+            remaining = fresh_until - epoch()
+            self.stale = remaining < 0
+            if remaining < (self.cache_refresh_ahead or 0) or self.stale:
+                self.revalidate()
+        return True
+
+    @staticmethod
+    def is_failure(result):
+        return result is False or (isinstance(result, Result) and result.result is False)
+
+    def store(self, result):
+        """ Store a result in the cache. When cache_negative_time is set failed results are kept for that long
+            instead (zero meaning failures are never cached). Streamed results (iterators) are never cached.
+            Returns true if the result was stored.
+        """
+        if isinstance(result, Iterator) or (isinstance(result, tuple) and result and isinstance(result[-1], Iterator)):
+            return False
+        fresh_for, ttl = self.cache_time, self.cache_ttl
+        if self.cache_negative_time is not None and self.is_failure(result):
+            fresh_for = ttl = self.cache_negative_time
+            self.negative = True
+        if not ttl:
+            return False
+
+        entry = make_entry(result, fresh_for)
+        self.redis.setj(f'{self.cache_key}:data', entry)
+        self.redis.expire(f'{self.cache_key}:data', ttl)
+        if self.local is not None:
+            self.local.set(self.cache_key, entry, ttl)
+        return True
+
+    def revalidate(self):
+        """ Recompute this result in a background green thread, unless another caller is already doing so """
+        lock = self.redis.lock(f'{self.cache_key}:refresh', timeout=COALESCE_LOCK_TIME, thread_local=False)
+        if lock.acquire(blocking=False):
+            self.refreshing = True
+            spawn_n(self.refresh, lock)
+
+    def refresh(self, lock):
+        try:
+            self.store(self.override.execute())
+        except:  # noqa: E722
+            self.logger.exception('Unable to refresh %s in the background', self.cache_key)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    def coalesce(self):
+        """ Make sure only one caller (across all nodes) executes a missing cache entry. The first caller takes
+            a short lock on the cache key and executes, everybody else waits for the result to be stored. If the
+            lock holder dies we fall back to executing once the lock has expired. Waiting stops at the call's
+            deadline, if it has one.
+        """
+        lock_time = COALESCE_LOCK_TIME if self.cache_coalesce is True else self.cache_coalesce
+        lock = self.redis.lock(self.cache_key, timeout=lock_time, thread_local=False)
+        give_up = time.monotonic() + lock_time
+        deadline = self.override.worker_ctx.context_data.get(DEADLINE_KEY)
+
+        while not lock.acquire(blocking=False):
+            if deadline and epoch() >= float(deadline):
+                self.logger.warning('Deadline passed while waiting on %s', self.cache_key)
+                self.set_fail('deadline exceeded')
+                return
+            if time.monotonic() > give_up:
+                self.logger.warning('Gave up waiting on %s, executing instead', self.cache_key)
+                return
+            sleep(COALESCE_POLL_INTERVAL)
+            if self.retrieve():
+                self.coalesced = True
+                return
+
+        self.lock = lock
+        # Somebody may have stored the result between our cache miss and taking the lock
+        self.retrieve()
 
     def pre_call(self):
-        cached_data = self.redis.getj(f'{self.cache_key}:data')
-        if cached_data:
-            self.set_result(cached_data, stop_executing=True)
-            self.retrieved = True
+        if not self.retrieve() and self.cache_coalesce and self.cache_time:
+            self.coalesce()
 
     def post_execute(self):
         if not self.retrieved and self.cache_time:
-            self.stored = True
-            self.redis.setj(f'{self.cache_key}:data', self.override.result)
-            self.redis.expire(f'{self.cache_key}:data', self.cache_time)
+            self.stored = self.store(self.override.result)
+
+    def post_call(self):
+        if self.lock is not None:
+            try:
+                self.lock.release()
+            except LockError:
+                self.logger.warning('Lock on %s expired before the call completed', self.cache_key)
+
+
+class BatchShim(Shim):
+    """ Runs the <method>_many entrypoint of a batch=True method. Each item is looked up in the method's own
+        cache first, only the misses are executed (together, once) and each of their results is cached and
+        returned just as the method would return it on its own.
+    """
+    name = 'batch'
+    items = ()
+    misses = ()
+    caches = ()
+    results = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.single = getattr(self.override.worker_ctx.service, self.override.options.batch_of)
+
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.batch_of)
+
+    def log_extra(self):
+        return {
+            'items': len(self.items),
+            'cached': len(self.items) - len(self.misses)
+        }
+
+    def item_cache(self, item):
+        """ The CachingShim the method would use if it were called with this item alone """
+        worker_ctx = self.override.worker_ctx
+        args, kwargs = item_arguments(item)
+        item_ctx = SimpleNamespace(
+            service=worker_ctx.service, entrypoint=worker_ctx.entrypoint, container=worker_ctx.container,
+            context_data=worker_ctx.context_data, args=args, kwargs=kwargs
+        )
+        return CachingShim(ShimExecutor(self.single, item_ctx, ()))
+
+    def pre_call(self):
+        worker_ctx = self.override.worker_ctx
+        self.items = list(worker_ctx.args[0] if worker_ctx.args else worker_ctx.kwargs['items'])
+        self.results = [MISSING] * len(self.items)
+        if CachingShim.applies_to(self.single._miso_options):
+            self.caches = [None] * len(self.items)
+            for idx, item in enumerate(self.items):
+                try:
+                    cache = self.caches[idx] = self.item_cache(item)
+                except Exception as exc:  # e.g. the item does not fit the method's signature, fail only that item
+                    self.logger.warning('Invalid item in a batch for %s: %s', self.override.service_id, exc)
+                    self.results[idx] = Result(result=False, reason='invalid batch item', detail=str(exc))
+                    continue
+                if cache.retrieve():
+                    self.results[idx] = cache.override.result
+
+        # Only the items we do not already have a result for get executed
+        self.misses = [idx for idx, result in enumerate(self.results) if result is MISSING]
+        worker_ctx.args, worker_ctx.kwargs = ([self.items[idx] for idx in self.misses],), {}
+        if not self.misses:
+            self.set_result([], stop_executing=True)
+
+    def post_call(self):
+        results = self.override.result
+        if not isinstance(results, list) or len(results) != len(self.misses):
+            return  # The batch failed as a whole
+
+        for idx, result in zip(self.misses, results):
+            cache = self.caches[idx] if self.caches else None
+            # A failed item may be an exception, which a call on its own would never cache, so failures are only
+            # kept when cache_negative_time says for how long
+            if cache and cache.cache_time and (cache.cache_negative_time is not None or not cache.is_failure(result)):
+                cache.stored = cache.store(result)
+            self.results[idx] = result
+        if self.single._miso_options.force_res_object:
+            self.override.result = [as_result(result) for result in self.results]
+        else:
+            self.override.result = list(self.results)
 
 
 class ForceObject(Shim):
     name = 'forceobj'
-    enabled = True
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.enabled = self.override.options.force_res_object
+    @classmethod
+    def applies_to(cls, options):
+        return bool(options.force_res_object)
 
     def post_call(self):
-        if self.enabled and not isinstance(self.override.result, (tuple, Response, Result)):
-            if isinstance(self.override.result, bool):
-                self.override.result = Result(result=self.override.result)
-            else:
-                self.override.result = Result(result=True, data=self.override.result)
+        self.override.result = as_result(self.override.result)
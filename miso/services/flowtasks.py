@@ -4,7 +4,7 @@ import json
 from nameko.standalone.rpc import ClusterRpcProxy
 from nameko.rpc import RpcProxy
 
-from miso.service import http_enhanced, rpc_enhanced, Service
+from miso.service import http_enhanced, rpc_enhanced, Service, CircuitClusterProxy
 from miso.utils import fake_proxy_config, epoch
 
 
@@ -44,7 +44,8 @@ class HttpService(Service):
     def invoke_rpc(self, result_key, service, method, *args, **kwargs):
         self.logger.info('invoking [%s.%s] and storing result at [%s]', service, method, result_key)
         with ClusterRpcProxy(fake_proxy_config()) as cluster_rpc:
-            func = getattr(getattr(cluster_rpc, service), method)
+            circuit_rpc = CircuitClusterProxy(cluster_rpc, redis=self.redis)
+            func = getattr(getattr(circuit_rpc, service), method)
             result = func(*args, **kwargs)
             if hasattr(result, 'to_dict'):
                 result = result.to_dict()
@@ -24,6 +24,7 @@ class ShellHelper:
 
 def create_shell(with_files, exit_after=False):
     config = dict(**EnvYAML('config.yml'))
+    register_better_json(config)
     banner = f'Nameko Python {sys.version}\nBroker is {config[AMQP_URI_CONFIG_KEY]}'
     n = make_nameko_helper(config)
     ctx = {'n': n, 'rpc': n.rpc, 'config': config, 'os': os, 'sys': sys, 'json': json, 'yaml': yaml}
@@ -38,7 +39,6 @@ def create_shell(with_files, exit_after=False):
 
 
 if __name__ == '__main__':
-    register_better_json()
     exit_after = False
     with_files = []
     for arg in sys.argv[1:]:
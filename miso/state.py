@@ -92,16 +92,17 @@ class State:
         os.environ['MISO_NODE_ADDRESS'] = self.node_address
 
     def update(self, **kwargs):
-        for key, val in kwargs.items():
-            self.redis.setj(f'miso:nodes:{self.node_id}:{key}', val)
+        node_id = self.node_id
+        self.redis.msetj({f'miso:nodes:{node_id}:{key}': val for key, val in kwargs.items()})
 
     def get_active_nodes(self, threshold=30):
         """ Returns a list of nodes that have been active within the last threshold (120) seconds
         -> [(1629312332, 'node-id')] """
         now = epoch()
         other_nodes = []
-        for node_id in self.redis.keys('miso:nodes:*:last_seen', idx=-2):
-            last_seen = self.redis.getj(f'miso:nodes:{node_id}:last_seen')
+        node_ids = list(self.redis.keys('miso:nodes:*:last_seen', idx=-2))
+        last_seens = self.redis.mgetj(f'miso:nodes:{node_id}:last_seen' for node_id in node_ids)
+        for node_id, last_seen in zip(node_ids, last_seens):
             if last_seen and now - last_seen < threshold:
                 other_nodes.append((last_seen, node_id))
         return sorted(other_nodes)
@@ -132,17 +133,22 @@ class State:
         return required
 
     def get_available_services(self):
-        for service_name, service_class, service_file, module in discover_services_in_path(self.service_path):
+        discovered = list(discover_services_in_path(self.service_path))
+        stored = self.redis.mgetj(
+            f'miso:services:{service_name}:{field}' for service_name, *_ in discovered for field in ('mtime', 'hash')
+        )
+        values = {}
+        for idx, (service_name, service_class, service_file, module) in enumerate(discovered):
             file_hash = md5file(service_file)
             file_mtime = int(os.stat(service_file).st_mtime)
             file_key = f'{service_file}'[(len(self.service_path) + 1):]
+            service_key = f'miso:services:{service_name}'
 
-            old_mtime = self.redis.getj(f'miso:services:{service_name}:mtime')
-            self.redis.setj(f'miso:services:{service_name}:file_key', file_key)
-            self.redis.setj(f'miso:services:{service_name}:last_seen', epoch())
+            old_mtime, load_hash = stored[idx * 2:idx * 2 + 2]
+            values.update({f'{service_key}:file_key': file_key, f'{service_key}:last_seen': epoch()})
             if not old_mtime or old_mtime < file_mtime:
-                self.redis.setj(f'miso:services:{service_name}:mtime', file_mtime)
-                self.redis.setj(f'miso:services:{service_name}:hash', file_hash)
+                values.update({f'{service_key}:mtime': file_mtime, f'{service_key}:hash': file_hash})
+                load_hash = file_hash
                 if old_mtime:
                     self.logger.debug('Reloading %s due to mtime', module)
                     importlib.reload(module)
@@ -151,8 +157,9 @@ class State:
                 'class': service_class,
                 'file': service_file,
                 'hash': file_hash,
-                'load_hash': self.redis.getj(f'miso:services:{service_name}:hash')
+                'load_hash': load_hash
             }
+        self.redis.msetj(values)
 
         return [self._services[svc]['class'] for svc in self._services]
 
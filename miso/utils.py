@@ -4,7 +4,7 @@ import re
 import hashlib
 import pendulum
 from socket import gethostname
-from munch import Munch, munchify
+from munch import Munch
 
 
 sleep = time.sleep
@@ -107,36 +107,66 @@ def md5file(filename):
 
 
 def automunchify(data):
-    return munchify(data, AutoMunch)
+    """ Convert a dict (or the dicts in a list) to AutoMunch. Only the outer level is converted here, nested
+        dicts and lists are converted by AutoMunch when they are first accessed.
+    """
+    if isinstance(data, AutoMunch) or type(data) is MunchList:
+        return data
+    if isinstance(data, dict):
+        return AutoMunch(data)
+    if isinstance(data, list):
+        return MunchList(automunchify(item) for item in data)
+    return data
+
+
+class MunchList(list):
+    """ A list whose dicts have already been converted to AutoMunch """
+    pass
 
 
 class AutoMunch(Munch):
-    """ Some addons yet to be included in Infinidat/munch:
-        https://github.com/Infinidat/munch/pull/36
+    """ A Munch whose nested dicts (also those inside lists) are Munches too. Nested values are converted
+        lazily, the first time they are read, and stored back in place; assigned values are kept as they are
+        (without copying) until then. See https://github.com/Infinidat/munch/pull/36
     """
 
-    def __setattr__(self, k, v):
-        """ Works the same as Munch.__setattr__ but if you supply
-            a dictionary as value it will convert it to another Munch.
-        """
-        if isinstance(v, (AutoMunch, Munch)):
-            v = automunchify(v.toDict())
-        elif isinstance(v, dict):
-            v = automunchify(v)
-        elif isinstance(v, list):
-            v = [automunchify(li) for li in v]
+    def __getitem__(self, k):
+        value = dict.__getitem__(self, k)
+        if type(value) in LAZY_TYPES:
+            value = automunchify(value)
+            dict.__setitem__(self, k, value)
+        return value
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def values(self):
+        for k in self:
+            self[k]
+        return dict.values(self)
+
+    def items(self):
+        for k in self:
+            self[k]
+        return dict.items(self)
+
 
-        super(AutoMunch, self).__setattr__(k, v)
+LAZY_TYPES = (dict, list, Munch)
 
 
 class Result(object):
     """ A service return template object. All services should return one of these so that output
-        of microservices remains consistent.
+        of microservices remains consistent. data is kept as it was given and only converted to an
+        AutoMunch when it is first accessed, so results that are just passed along are never converted.
     """
+    __slots__ = ('_data', '_munched', '_result', 'reason', 'detail', 'trace', 'locked')
 
     def __init__(self, data=None, result=None, trace=None, locked=None, reason=None, detail=None):
-        self.data = automunchify(data) if data is not None else None
-        self.result = result if result is not None else bool(self.data)
+        self._data = data
+        self._munched = data is None
+        self._result = result if result is not None else bool(data)
         self.reason = reason
         self.detail = detail
         self.trace = trace
@@ -144,6 +174,26 @@ class Result(object):
         if self.trace and not reason:
             self.reason = 'uncaught exception (traceback in service)'
 
+    @property
+    def data(self):
+        if not self._munched:
+            self._data = automunchify(self._data)
+            self._munched = True
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._munched = data is None
+
+    @property
+    def result(self):
+        return self._result if self._result is not None else self._data is not None
+
+    @result.setter
+    def result(self, result):
+        self._result = result
+
     @property
     def traceback(self):
         """ Returns true if this ServiceResult is an exception """
@@ -154,13 +204,13 @@ class Result(object):
         return {
             'result': self.result,
             'reason': self.reason,
-            'data': self.data.toDict() if isinstance(self.data, AutoMunch) else self.data,
-            'detail': self.detail.toDict() if isinstance(self.detail, AutoMunch) else self.detail,
+            'data': self._data.toDict() if isinstance(self._data, Munch) else self._data,
+            'detail': self.detail.toDict() if isinstance(self.detail, Munch) else self.detail,
             'trace': self.trace
         }
 
     def __repr__(self):
-        short_data = str(self.data.toDict() if isinstance(self.data, AutoMunch) else self.data)
+        short_data = str(self._data.toDict() if isinstance(self._data, Munch) else self._data)
         if len(short_data) > 30:
             short_data = short_data[0:27] + '...'
         if self.traceback:
@@ -168,9 +218,3 @@ class Result(object):
             return f'<Result(result={self.result}, exception={last_line})>'
         else:
             return f'<Result(result={self.result}, data={short_data})>'
-
-    def __getattribute__(self, item):
-        real = super().__getattribute__(item)
-        if item == 'result':
-            real = real if real is not None else self.data is not None
-        return real
@@ -0,0 +1,82 @@
+import eventlet
+import pytest
+
+from miso.service import Service, rpc_enhanced
+from miso.service.modification import MisoServiceContainer
+from miso.utils import Result
+
+
+class AdmissionService(Service):
+    name = 'admission_test'
+
+    @rpc_enhanced(max_concurrency=1)
+    def limited(self):
+        pass
+
+    @rpc_enhanced
+    def unlimited(self):
+        pass
+
+
+@pytest.fixture
+def container():
+    container = MisoServiceContainer(
+        AdmissionService, {'max_workers': 2, 'MISO_MAX_QUEUE': 1, 'AMQP_URI': 'memory://'}
+    )
+    for entrypoint in container.entrypoints:
+        entrypoint.miso_options = getattr(AdmissionService, entrypoint.method_name)._miso_options
+    container.running = {}
+    container.peak = {}
+
+    def run_worker(worker_ctx, handle_result):
+        name = worker_ctx.entrypoint.method_name
+        container.running[name] = container.running.get(name, 0) + 1
+        container.peak[name] = max(container.peak.get(name, 0), container.running[name])
+        eventlet.sleep(0.05)
+        container.running[name] -= 1
+        handle_result(worker_ctx, 'ok', None)
+
+    container._run_worker = run_worker
+    return container
+
+
+def saturate(container, method_names):
+    """ Calls every method at once, each from its own green thread as the entrypoints would """
+    entrypoints = {entrypoint.method_name: entrypoint for entrypoint in container.entrypoints}
+    results = []
+
+    def handle_result(worker_ctx, result, exc_info):
+        results.append(result)
+        return result, exc_info
+
+    def call(method_name):
+        container.spawn_worker(entrypoints[method_name], (), {}, handle_result=handle_result)
+
+    pool = eventlet.GreenPool()
+    for method_name in method_names:
+        pool.spawn(call, method_name)
+    pool.waitall()
+    container._worker_pool.waitall()
+    return results
+
+
+def shed(results):
+    return [result for result in results if isinstance(result, Result) and result.reason == 'service overloaded']
+
+
+def test_max_concurrency_holds_while_callers_wait(container):
+    # The pool is full, so the first limited call waits for a worker and the others must not join it
+    results = saturate(container, ['unlimited'] * 2 + ['limited'] * 10)
+    assert container.peak['limited'] == 1
+    assert len(shed(results)) == 9
+    assert container.miso_rejections['admission_test.limited'] == 9
+    assert container.miso_in_flight['limited'] == 0
+
+
+def test_calls_beyond_the_queue_are_shed(container):
+    results = saturate(container, ['unlimited'] * 12)
+    # Two calls run and one waits for a worker, the other nine are shed at once
+    assert len(shed(results)) == 9
+    assert results.count('ok') == 3
+    assert container.peak['unlimited'] == 2
+    assert container._worker_pool.waiting == 0
@@ -0,0 +1,19 @@
+import pytest
+
+from miso.service.modification import MAX_REQUEST_TIMEOUT, request_timeout
+
+
+@pytest.mark.parametrize('value, timeout', [
+    ('2.5', 2.5),
+    ('10', 10),
+    (str(MAX_REQUEST_TIMEOUT * 10), MAX_REQUEST_TIMEOUT),
+    ('inf', MAX_REQUEST_TIMEOUT),
+    (None, None),
+    ('', None),
+    ('soon', None),
+    ('0', None),
+    ('-5', None),
+    ('nan', None),
+])
+def test_request_timeout(value, timeout):
+    assert request_timeout(value) == timeout
@@ -0,0 +1,136 @@
+from datetime import datetime, date, timedelta, timezone
+from types import SimpleNamespace
+
+import pendulum
+import pytest
+from kombu.serialization import dumps, loads
+
+from miso import encoder
+from miso.encoder import register_better_json
+from miso.utils import Result
+
+
+msgpack = pytest.importorskip('msgpack')
+register_better_json()
+
+NOW = pendulum.datetime(2021, 3, 4, 5, 6, 7, 891011, tz='Australia/Sydney')
+VALUES = {
+    'naive datetime': datetime(2021, 3, 4, 5, 6, 7, 891011),
+    'aware datetime': NOW,
+    'utc datetime': pendulum.datetime(2021, 3, 4, 5, 6, 7, tz='UTC'),
+    'fixed offset datetime': datetime(2021, 3, 4, 5, 6, 7, tzinfo=timezone(timedelta(hours=-3, minutes=-30))),
+    'pendulum fixed offset datetime': pendulum.datetime(2021, 3, 4, 5, 6, 7, tz=pendulum.fixed_timezone(19800)),
+    'date': date(2021, 3, 4),
+    'timedelta': timedelta(days=-2, seconds=5, microseconds=7),
+    'nested': {'when': [NOW, date(2020, 2, 29)], 'for': timedelta(hours=1)},
+}
+
+
+def round_trip(value, serializer):
+    content_type, encoding, data = dumps(value, serializer=serializer)
+    return loads(data, content_type, encoding)
+
+
+def describe(value):
+    """ Something comparable that tells apart otherwise equal values with different types or timezones """
+    if isinstance(value, Result):
+        return 'Result', describe(value.to_dict())
+    if isinstance(value, dict):
+        return {key: describe(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [describe(val) for val in value]
+    if isinstance(value, datetime):
+        return 'datetime', value.isoformat(), str(value.tzinfo)
+    return type(value).__name__, value
+
+
+@pytest.mark.parametrize('name', VALUES)
+def test_serializers_agree(name):
+    value = VALUES[name]
+    from_json = round_trip(value, 'betterjson')
+    from_msgpack = round_trip(value, 'bettermsgpack')
+    assert describe(from_msgpack) == describe(from_json)
+
+
+@pytest.mark.parametrize('name', [name for name in VALUES if name != 'naive datetime'])
+def test_values_survive(name):
+    value = VALUES[name]
+    for serializer in ('betterjson', 'bettermsgpack'):
+        assert round_trip(value, serializer) == value
+
+
+def test_naive_datetimes_become_utc():
+    for serializer in ('betterjson', 'bettermsgpack'):
+        decoded = round_trip(VALUES['naive datetime'], serializer)
+        assert decoded == VALUES['naive datetime'].replace(tzinfo=timezone.utc)
+
+
+def test_results():
+    result = Result(data={'rows': [{'id': 1, 'when': NOW}]}, result=True, reason='ok', detail='some detail')
+    for serializer in ('betterjson', 'bettermsgpack'):
+        decoded = round_trip(result, serializer)
+        assert isinstance(decoded, Result)
+        assert decoded.locked
+        assert decoded.to_dict() == result.to_dict()
+    assert describe(round_trip(result, 'bettermsgpack')) == describe(round_trip(result, 'betterjson'))
+
+
+def test_failed_results():
+    result = Result(result=False, trace='Traceback ...')
+    for serializer in ('betterjson', 'bettermsgpack'):
+        decoded = round_trip(result, serializer)
+        assert decoded.result is False
+        assert decoded.traceback
+        assert decoded.reason == result.reason
+
+
+class FakeRaw(dict):
+    def set(self, key, value, ex=None):
+        self[key] = value
+
+    def get(self, key):
+        return dict.get(self, key)
+
+
+@pytest.fixture
+def claim_check(monkeypatch):
+    redis = SimpleNamespace(raw=FakeRaw(), compress_level=6)
+    monkeypatch.setattr(encoder, 'CLAIM_CHECK', encoder.ClaimCheck(redis, threshold=1000))
+    return redis.raw
+
+
+@pytest.mark.parametrize('serializer', ['betterjson', 'bettermsgpack'])
+def test_large_messages_are_sent_by_claim_check(claim_check, serializer):
+    body = {'args': [Result(data=[{'id': i, 'when': NOW} for i in range(100)])], 'kwargs': {}}
+    content_type, encoding, data = dumps(body, serializer=serializer)
+    assert len(data) < 100
+    assert len(claim_check) == 1
+    decoded = loads(data, content_type, encoding)
+    assert decoded['args'][0].to_dict() == body['args'][0].to_dict()
+
+
+@pytest.mark.parametrize('serializer', ['betterjson', 'bettermsgpack'])
+def test_expired_claim_checks_become_errors(claim_check, serializer):
+    content_type, encoding, data = dumps({'result': 'x' * 2000, 'error': None}, serializer=serializer)
+    claim_check.clear()
+    decoded = loads(data, content_type, encoding)
+    assert decoded['result'] is None
+    assert decoded['error']['exc_type'] == 'ClaimCheckError'
+
+
+def test_claim_checks_are_only_resolved_for_messages(claim_check):
+    stored = {'__type__': 'claim', 'key': 'miso:blob:stored'}
+    assert encoder.loads(encoder.dumps(stored)) == stored
+
+
+def test_messages_are_verbose_unless_compact_encoding_is_enabled(monkeypatch):
+    monkeypatch.setattr(encoder, 'MESSAGE_ENCODER', encoder.MESSAGE_ENCODER)
+    register_better_json({})
+    assert '"__type__": "datetime"' in dumps(NOW, serializer='betterjson')[2]
+
+    register_better_json({'MISO_COMPACT_ENCODING': True})
+    content_type, encoding, data = dumps(NOW, serializer='betterjson')
+    assert '"__type__": "dt"' in data
+    assert loads(data, content_type, encoding) == NOW
+    # Anything else, e.g. HTTP responses and Redis values, keeps the verbose encoding
+    assert '"__type__": "datetime"' in encoder.dumps(NOW)
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from miso.service import Service, http_enhanced
+from miso.service import modification
+from miso.service.modification import MisoHttpRequestHandler
+from miso.utils import Result
+
+
+class RecordingCache:
+    """ Stands in for HttpCache, always misses and remembers what was stored """
+    stored = []
+
+    def __init__(self, worker_ctx, options):
+        pass
+
+    def get(self):
+        return None
+
+    def set(self, status_code, headers, body):
+        self.stored.append((status_code, body))
+
+
+class HttpCacheService(Service):
+    name = 'http_cache_test'
+
+    @http_enhanced('GET', '/ok', cache_time=60)
+    def ok(self, request):
+        return {'ok': True}
+
+    @http_enhanced('GET', '/failed', cache_time=60)
+    def failed(self, request):
+        return Result(result=False, reason='permission denied')
+
+    @http_enhanced('GET', '/raises', cache_time=60)
+    def raises(self, request):
+        raise ValueError('transient')
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(modification, 'HttpCache', RecordingCache)
+    RecordingCache.stored = []
+    return RecordingCache
+
+
+def call(method_name):
+    service = HttpCacheService()
+    method = getattr(service, method_name)
+    handler = SimpleNamespace(
+        miso_options=method._miso_options, miso_shims=(), container=SimpleNamespace(config={})
+    )
+    entrypoint = SimpleNamespace(method_name=method_name)
+    worker_ctx = SimpleNamespace(
+        service=service, entrypoint=entrypoint, container=handler.container, context_data={}, data={},
+        args=(Request(EnvironBuilder(f'/{method_name}').get_environ()),), kwargs={}
+    )
+    return MisoHttpRequestHandler.miso_call(handler, method, worker_ctx)
+
+
+def test_successful_responses_are_cached(cache):
+    response = call('ok')
+    assert response.status_code == 200
+    assert len(cache.stored) == 1
+
+
+@pytest.mark.parametrize('method_name', ['failed', 'raises'])
+def test_failed_results_are_not_cached(cache, method_name):
+    response = call(method_name)
+    assert response.status_code == 200
+    assert cache.stored == []